@@ -1,19 +1,69 @@
 import itertools
+import inspect
+import re
 import teneto
 import os
-import re
-from bids import BIDSLayout
 import numpy as np
-import inspect
-import matplotlib.pyplot as plt
 import json
-import nilearn
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from scipy.interpolate import interp1d
-from ..utils.bidsutils import load_tabular_file, get_bids_tag, get_sidecar, confound_matching, process_exclusion_criteria, drop_bids_suffix, make_directories
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from ..utils.bidsutils import _TAG_RE, _FILEFORMAT_RE, _exclusion_mask, load_tabular_file, get_bids_tag, get_sidecar, save_sidecar, confound_matching, process_exclusion_criteria, drop_bids_suffix, make_directories
 import pandas as pd
 from .network import TemporalNetwork
 import sys
+from collections import OrderedDict
+from functools import lru_cache
+
+# BIDSLayouts already indexed in this process, keyed by directory, the state of its directory tree and layout database
+_LAYOUT_CACHE = OrderedDict()
+_LAYOUT_CACHE_SIZE = 8
+# Name of the derivatives pipeline that teneto saves to
+_TENETO_PIPELINE = 'teneto_' + teneto.__version__
+
+
+def _tree_signature(path):
+    """
+    Returns the number of directories in the tree under path and the latest modification time (ns) among them.
+
+    Adding or removing a file anywhere in the tree changes the modification time of its directory,
+    so the signature changes whenever the files a BIDSLayout would index change.
+    The derivatives directory is not indexed by BIDSLayout (and is where teneto writes its output), so it is skipped.
+    """
+    ndirs = 0
+    latest = 0
+    for dirpath, dirnames, _ in os.walk(path):
+        if dirpath == path and 'derivatives' in dirnames:
+            dirnames.remove('derivatives')
+        ndirs += 1
+        try:
+            latest = max(latest, os.stat(dirpath).st_mtime_ns)
+        except OSError:
+            pass
+    return ndirs, latest
+
+
+def _get_layout(BIDS_dir, layout_db=None):
+    """
+    Returns a BIDSLayout of BIDS_dir, reusing one already indexed in this process if no file in BIDS_dir has been added or removed since.
+
+    If layout_db is given, the layout index is loaded from (or saved to) that database path so other processes can skip indexing.
+    """
+    key = (os.path.abspath(BIDS_dir), _tree_signature(BIDS_dir), layout_db)
+    if key in _LAYOUT_CACHE:
+        _LAYOUT_CACHE.move_to_end(key)
+        return _LAYOUT_CACHE[key]
+    from bids import BIDSLayout
+    if layout_db:
+        # Saved layout databases were added to pybids after the 0.7 versions teneto supports
+        if 'database_path' not in inspect.signature(BIDSLayout.__init__).parameters:
+            raise ValueError(
+                'layout_db requires pybids 0.10 or newer (BIDSLayout database_path). Upgrade pybids or set layout_db=None.')
+        layout = BIDSLayout(BIDS_dir, validate=False, database_path=layout_db)
+    else:
+        layout = BIDSLayout(BIDS_dir, validate=False)
+    _LAYOUT_CACHE[key] = layout
+    if len(_LAYOUT_CACHE) > _LAYOUT_CACHE_SIZE:
+        _LAYOUT_CACHE.popitem(last=False)
+    return layout
 
 # class NetworkMeasures:
 #    def __init__(self,**kwargs):
@@ -24,10 +74,33 @@ import sys
 #    print(teneto.networkmeasures.temporal_degree_centrality(self,**kwargs))
 
 
+def _chunksize(njobs, n):
+    """
+    Returns the chunksize for executor.map over n jobs in njobs workers.
+
+    About four chunks per worker keeps the workers balanced while sending few batches between processes.
+    """
+    return max(1, n // (njobs * 4))
+
+
+def _dir_mtime(path):
+    """
+    Returns the modification time (ns) of directory path, or None if it does not exist.
+    """
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
 class TenetoBIDS:
 
     bids_derivatives_rc_version = '<rc1.0'
 
+    # Arguments of __init__ (each is also an attribute). Saved by save_tenetobids_snapshot.
+    _init_params = ('BIDS_dir', 'pipeline', 'pipeline_subdir', 'parcellation', 'bids_tags', 'bids_suffix',
+                    'bad_subjects', 'confound_pipeline', 'raw_data_exists', 'njobs', 'history', 'layout_db')
+
     tenetoinfo = {
         "Name": "TenetoBIDS",
                 "PipelineDescription": {
@@ -40,7 +113,7 @@ class TenetoBIDS:
         "HowToAcknowledge": "Cite Teneto's DOI (http://doi.org/10.5281/zenodo.2535994).",
     }
 
-    def __init__(self, BIDS_dir, pipeline=None, pipeline_subdir=None, parcellation=None, bids_tags=None, bids_suffix=None, bad_subjects=None, confound_pipeline=None, raw_data_exists=True, njobs=None, history=None):
+    def __init__(self, BIDS_dir, pipeline=None, pipeline_subdir=None, parcellation=None, bids_tags=None, bids_suffix=None, bad_subjects=None, confound_pipeline=None, raw_data_exists=True, njobs=None, history=None, layout_db=None):
         """
         Parameters
         ----------
@@ -71,15 +144,20 @@ class TenetoBIDS:
             Default is True. If the unpreprocessed data is not present in BIDS_dir, set to False. Some BIDS funcitonality will be lost.
         njobs : int, optional
             How many parallel jobs to run. Default: 1. The set value can be overruled in individual functions.
+        layout_db : str, optional
+            Path to a pybids layout database. If it exists the BIDS layout is loaded from it, otherwise the index is saved there. Avoids reindexing large datasets.
+            Requires pybids 0.10 or newer.
         """
+        self._selected_files_cache = {}
         if history is not None:
             self.history = history
         else:
-            self.add_history(inspect.stack()[0][3], locals(), 1)
+            self.add_history(sys._getframe().f_code.co_name, locals(), 1)
         self.contact = []
 
+        self.layout_db = layout_db
         if raw_data_exists:
-            self.BIDS = BIDSLayout(BIDS_dir, validate=False)
+            self.BIDS = _get_layout(BIDS_dir, layout_db)
         else:
             self.BIDS = None
 
@@ -127,6 +205,15 @@ class TenetoBIDS:
         self.temporalnetwork_trialinfo_ = []
         self.fc_trialinfo_ = []
 
+    @staticmethod
+    def clear_layout_cache():
+        """
+        Drops the BIDSLayouts that TenetoBIDS has cached in this process, so the next TenetoBIDS reindexes its BIDS_dir.
+
+        Layouts are already reindexed when files are added or removed, so this is only needed to force reindexing.
+        """
+        _LAYOUT_CACHE.clear()
+
     def add_history(self, fname, fargs, init=0):
         """
         Adds a processing step to TenetoBIDS.history.
@@ -193,7 +280,7 @@ class TenetoBIDS:
         """
         if not njobs:
             njobs = self.njobs
-        self.add_history(inspect.stack()[0][3], locals(), 1)
+        self.add_history(sys._getframe().f_code.co_name, locals(), 1)
 
         files = self.get_selected_files(quiet=1)
         confound_files = self.get_selected_files(quiet=1, pipeline='confound')
@@ -203,132 +290,55 @@ class TenetoBIDS:
             confounds_exist = False
         if not confound_corr_report:
             confounds_exist = False
+        if confounds_exist:
+            # Pair files by their tags, the two lists are not in the same order
+            confound_file = dict(zip(*confound_matching(files, confound_files)))
 
         if not tag:
             tag = ''
         else:
             tag = 'desc-' + tag
 
-        with ProcessPoolExecutor(max_workers=njobs) as executor:
-            job = {executor.submit(self._derive_temporalnetwork, f, i, tag, params,
-                                   confound_files) for i, f in enumerate(files) if f}
-            for j in as_completed(job):
-                j.result()
+        # Output paths and fc files are found here so the workers only receive strings
+        fc_params = [p for p in ['weight-var', 'weight-mean']
+                     if isinstance(params.get(p), str) and params[p] == 'from-subject-fc']
+        jobs = []
+        save_dirs = []
+        for f in files:
+            if not f:
+                continue
+            fs, _ = drop_bids_suffix(f)
+            save_name, save_dir, _ = self._save_namepaths_bids_derivatives(
+                fs, tag, 'tvc', 'tvcconn', make_dirs=False)
+            save_dirs.append(save_dir)
+            if confounds_exist:
+                save_dirs.append(save_dir + 'report/')
+            if fc_params:
+                fc_files = self.get_selected_files(
+                    quiet=1, pipeline='functionalconnectivity', forfile=f)
+            else:
+                fc_files = None
+            if confounds_exist:
+                jobs.append((f, save_name, save_dir, params, fc_files, confound_file[f]))
+            else:
+                jobs.append((f, save_name, save_dir, params, fc_files))
+        # Many files share a directory so each is only created once
+        self._make_derivatives_directories(save_dirs)
 
-        if confounds_exist:
-            for i, f in enumerate(files):
-                analysis_step = 'tvc-derive'
-                df = load_tabular_file(confound_files[i])
-                df = df.fillna(df.median())
-                fs, _ = drop_bids_suffix(f)
-                saved_name, saved_dir, _ = self._save_namepaths_bids_derivatives(fs, tag, 'tvc', 'tvcconn')
-                data = load_tabular_file(saved_dir + saved_name + '.tsv')
-                dfc = TemporalNetwork(from_df=data).df_to_array()
-                ind = np.triu_indices(dfc.shape[0], k=1)
-                dfc_df = pd.DataFrame(dfc[ind[0], ind[1], :].transpose())
-                # If windowed, prune df so that it matches with dfc_df
-                if len(df) != len(dfc_df):
-                    df = df.iloc[int(np.round((params['windowsize']-1)/2)): int(np.round((params['windowsize']-1)/2)+len(dfc_df))]
-                    df.reset_index(inplace=True, drop=True)
-                # NOW CORRELATE DF WITH DFC BUT ALONG INDEX NOT DF.
-                dfc_df_z = (dfc_df - dfc_df.mean())
-                df_z = (df - df.mean())
-                R_df = dfc_df_z.T.dot(df_z).div(len(dfc_df)).div(
-                    df_z.std(ddof=0)).div(dfc_df_z.std(ddof=0), axis=0)
-                description = R_df.describe().transpose().to_html()
-                confound_report_dir = saved_dir + '/report/'
-                if not os.path.exists(confound_report_dir):
-                    os.makedirs(confound_report_dir)
-                report = '<html><body>'
-                report += '<h1> Correlation of ' + analysis_step + ' and confounds.</h1>'
-                confound_hist = []
-                for c in R_df.columns:
-                    confound_hist.append(pd.cut(
-                        R_df[c], bins=np.arange(-1, 1.01, 0.025)).value_counts().sort_index().values/len(R_df))
-
-                fig, ax = plt.subplots(1, figsize=(8, 1*R_df.shape[-1]))
-                pax = ax.imshow(
-                    confound_hist, extent=[-1, 1, R_df.shape[-1], 0], cmap='inferno', vmin=0, vmax=1)
-                ax.set_aspect('auto')
-                ax.set_yticks(np.arange(0.5, R_df.shape[-1]))
-                ax.set_yticklabels(R_df.columns)
-                ax.set_xlabel('r')
-                plt.colorbar(pax)
-                plt.tight_layout()
-                fig.savefig(confound_report_dir + saved_name +
-                            'confounds_2dhist.png', r=300)
-
-                report += 'The plot below shows histograms of each confound.<br><br>'
-                report += '<img src=' + \
-                    confound_report_dir + saved_name + 'confounds_2dhist.png><br><br>'
-                report += '<p>'
-                report += description
-                report += '</body></html>'
-
-                with open(confound_report_dir + saved_name + '_confoundcorr.html', 'w') as file:
-                    file.write(report)
+        # The confound reports are made by the same workers, right after each network is derived
+        # executor.map sends the jobs to the workers in chunks
+        with ProcessPoolExecutor(max_workers=njobs) as executor:
+            list(executor.map(_run_derive_temporalnetwork, *zip(*jobs),
+                              chunksize=_chunksize(njobs, len(jobs))))
+        self._clear_file_caches()
 
         if update_pipeline == True:
             if not self.confound_pipeline and len(self.get_selected_files(quiet=1, pipeline='confound')) > 0:
                 self.set_confound_pipeline(self.pipeline)
-            self.set_pipeline('teneto_' + teneto.__version__)
+            self.set_pipeline(_TENETO_PIPELINE)
             self.set_pipeline_subdir('tvc')
             self.set_bids_suffix('tvcconn')
 
-    def _derive_temporalnetwork(self, f, i, tag, params, confound_files):
-        """
-        Funciton called by TenetoBIDS.derive_temporalnetwork for concurrent processing.
-        """
-        data = load_tabular_file(f, index_col=True, header=True)
-
-        fs, _ = drop_bids_suffix(f)
-        save_name, save_dir, _ = self._save_namepaths_bids_derivatives(
-            fs, tag, 'tvc', 'tvcconn')
-
-        if 'weight-var' in params.keys():
-            if params['weight-var'] == 'from-subject-fc':
-                fc_files = self.get_selected_files(
-                    quiet=1, pipeline='functionalconnectivity', forfile=f)
-                if len(fc_files) == 1:
-                    # Could change to load_data call
-                    params['weight-var'] = load_tabular_file(
-                        fc_files[0]).values
-                else:
-                    raise ValueError('Cannot correctly find FC files')
-
-        if 'weight-mean' in params.keys():
-            if params['weight-mean'] == 'from-subject-fc':
-                fc_files = self.get_selected_files(
-                    quiet=1, pipeline='functionalconnectivity', forfile=f)
-                if len(fc_files) == 1:
-                    # Could change to load_data call
-                    params['weight-mean'] = load_tabular_file(
-                        fc_files[0]).values
-                else:
-                    raise ValueError('Cannot correctly find FC files')
-
-        if 'dimord' not in params:
-            params['dimord'] = 'time,node'
-
-        dfc = teneto.timeseries.derive_temporalnetwork(data.values, params)
-        dfc_net = TemporalNetwork(
-            from_array=dfc, nettype='wu', forcesparse=True)
-        dfc_net.network.to_csv(save_dir + save_name + '.tsv', sep='\t')
-
-        sidecar = get_sidecar(f)
-        sidecar['tvc'] = params
-        if 'weight-var' in sidecar['tvc']:
-            sidecar['tvc']['weight-var'] = True
-            sidecar['tvc']['fc source'] = fc_files
-        if 'weight-mean' in sidecar['tvc']:
-            sidecar['tvc']['weight-mean'] = True
-            sidecar['tvc']['fc source'] = fc_files
-        sidecar['tvc']['inputfile'] = f
-        sidecar['tvc']['description'] = 'Time varying connectivity information.'
-        with open(save_dir + save_name + '.json', 'w') as fs:
-            json.dump(sidecar, fs)
-
-
     def set_bids_tags(self, indict=None):
         if not hasattr(self, 'bids_tags'):
             # print(hasattr(self,'bids_tags'))
@@ -395,30 +405,28 @@ class TenetoBIDS:
         """
         if not njobs:
             njobs = self.njobs
-        self.add_history(inspect.stack()[0][3], locals(), 1)
+        self.add_history(sys._getframe().f_code.co_name, locals(), 1)
         files = self.get_selected_files(quiet=1)
 
-        R_group = []
+        jobs = []
+        for f in files:
+            sf, _ = drop_bids_suffix(f)
+            save_name, save_dir, _ = self._save_namepaths_bids_derivatives(
+                sf, '', 'fc', 'conn', make_dirs=False)
+            jobs.append((f, save_name, save_dir, file_hdr, file_idx))
+        self._make_derivatives_directories([job[2] for job in jobs])
+
+        # R_group is in the same order as files
         with ProcessPoolExecutor(max_workers=njobs) as executor:
-            job = {executor.submit(
-                self._run_make_functional_connectivity, f, file_hdr, file_idx) for f in files}
-            for j in as_completed(job):
-                R_group.append(j.result())
+            R_group = list(executor.map(_run_make_functional_connectivity, *zip(*jobs),
+                                        chunksize=_chunksize(njobs, len(jobs))))
+        self._clear_file_caches()
 
         if returngroup:
             # Fisher tranform -> mean -> inverse fisher tranform
             return np.tanh(np.mean(np.arctanh(np.array(R_group)), axis=0))
 
-    def _run_make_functional_connectivity(self, f, file_hdr, file_idx):
-        sf, _ = drop_bids_suffix(f)
-        save_name, save_dir, _ = self._save_namepaths_bids_derivatives(
-            sf, '', 'fc', 'conn')
-        data = load_tabular_file(f)
-        R = data.transpose().corr()
-        R.to_csv(save_dir + save_name + '.tsv', sep='\t')
-        return R.values
-
-    def _save_namepaths_bids_derivatives(self, f, tag, save_directory, suffix=None):
+    def _save_namepaths_bids_derivatives(self, f, tag, save_directory, suffix=None, make_dirs=True):
         """
         Creates output directory and output name
 
@@ -432,6 +440,8 @@ class TenetoBIDS:
             additional directory that the output file should go in
         suffix : str
             add new suffix to data
+        make_dirs : bool
+            If False, the directory is not created here. Then the caller should pass save_dir to _make_derivatives_directories (e.g. once for many files).
 
         Returns
         -------
@@ -443,7 +453,7 @@ class TenetoBIDS:
             subjective base directory (i.e. derivatives/teneto/func[/anythingelse/])
 
         """
-        file_name = f.split('/')[-1].split('.')[0]
+        file_name = os.path.basename(f).split('.')[0]
         if tag != '':
             tag = '_' + tag
         if suffix:
@@ -458,14 +468,81 @@ class TenetoBIDS:
                 0]
         else:
             paths_post_pipeline = paths_post_pipeline[1].split(file_name)[0]
-        base_dir = self.BIDS_dir + '/derivatives/' + 'teneto_' + \
-            teneto.__version__ + '/' + paths_post_pipeline + '/'
-        save_dir = base_dir + '/' + save_directory + '/'
-        make_directories(save_dir)
-        with open(self.BIDS_dir + '/derivatives/' + 'teneto_' + teneto.__version__ + '/dataset_description.json', 'w') as fs:
-            json.dump(self.tenetoinfo, fs)
+        teneto_dir = os.path.join(
+            self.BIDS_dir, 'derivatives', _TENETO_PIPELINE)
+        base_dir = os.path.join(teneto_dir, paths_post_pipeline.strip('/'), '')
+        save_dir = os.path.join(base_dir, save_directory, '')
+        if make_dirs:
+            self._make_derivatives_directories([save_dir])
         return save_name, save_dir, base_dir
 
+    def _clear_file_caches(self):
+        """
+        Forgets cached directory listings after this object has written files.
+
+        The cached listings are also checked against directory mtimes, but on filesystems with
+        coarse mtimes a file written in the same tick as the listing would otherwise be missed.
+        """
+        self._selected_files_cache.clear()
+        _list_tsv_files.cache_clear()
+
+    def _make_derivatives_directories(self, save_dirs):
+        """
+        Creates each of the unique save_dirs and the dataset_description.json of the teneto derivatives.
+        """
+        for save_dir in set(save_dirs):
+            make_directories(save_dir)
+        # The description only depends on the teneto version (which is in the path), so it is written once
+        description_path = os.path.join(
+            self.BIDS_dir, 'derivatives', _TENETO_PIPELINE, 'dataset_description.json')
+        if not os.path.exists(description_path):
+            with open(description_path, 'w') as fs:
+                json.dump(self.tenetoinfo, fs)
+
+    def _derivatives_savename(self, f, desc, overwrite):
+        """
+        Output name (without the suffix) of a file made from f in set_exclusion_timepoint or removeconfounds.
+
+        If the pipeline is not already teneto, the output is moved to the teneto derivatives (and the directory is created).
+
+        Parameters
+        ----------
+        f : str
+            input file
+        desc : str
+            replaces the desc tag of f (if f has a desc tag)
+        overwrite : bool
+            if False, raises an error if the output already exists
+
+        Returns
+        -------
+        sname : str
+            path and name of the output without the suffix
+        """
+        sname, _ = drop_bids_suffix(f)
+        bname = os.path.basename(sname)
+        # Move files to teneto derivatives if the pipeline isn't already set to it
+        if self.pipeline != _TENETO_PIPELINE:
+            sname = bname
+            spath = self.BIDS_dir + '/derivatives/' + _TENETO_PIPELINE + '/'
+            tags = get_bids_tag(sname, ['sub', 'ses'])
+            spath += 'sub-' + tags['sub'] + '/'
+            if 'ses' in tags:
+                spath += 'ses-' + tags['ses'] + '/'
+            spath += 'func/'
+            if self.pipeline_subdir:
+                spath += self.pipeline_subdir + '/'
+            make_directories(spath)
+            sname = spath + sname
+        if 'desc' in sname and desc:
+            desctag = get_bids_tag(bname, 'desc')
+            sname = ''.join(sname.split('desc-' + desctag['desc']))
+            sname += '_desc-' + desc
+        if os.path.exists(sname + self.bids_suffix + '.tsv') and overwrite == False:
+            raise ValueError(
+                'overwrite is set to False, but non-unique filename. Set unique desc tag')
+        return sname
+
     def get_tags(self, tag, quiet=1):
         """
         Returns which tag alternatives can be identified in the BIDS derivatives structure.
@@ -488,10 +565,8 @@ class TenetoBIDS:
                 files = self.get_selected_files(quiet=1)
                 tag_alternatives = []
                 for f in files:
-                    f = f.split('.')[0]
-                    f = f.split('/')[-1]
-                    tag_alternatives += [t.split('-')[1]
-                                         for t in f.split('_') if t.split('-')[0] == tag]
+                    f = os.path.basename(f).split('.')[0]
+                    tag_alternatives += [v for k, v in _TAG_RE.findall(f) if k == tag]
                 tag_alternatives = set(tag_alternatives)
             if quiet == 0:
                 print(tag + ' alternatives: ' + ', '.join(tag_alternatives))
@@ -528,17 +603,18 @@ class TenetoBIDS:
         else:
             pipeline_subdir_alternatives = []
             for s in self.bids_tags['sub']:
-                derdir_files = os.listdir(
-                    self.BIDS_dir + '/derivatives/' + self.pipeline + '/sub-' + s + '/func/')
+                func_dir = os.path.join(
+                    self.BIDS_dir, 'derivatives', self.pipeline, 'sub-' + s, 'func')
+                derdir_files = os.listdir(func_dir)
                 pipeline_subdir_alternatives += [
-                    f for f in derdir_files if os.path.isdir(self.BIDS_dir + '/derivatives/' + self.pipeline + '/sub-' + s + '/func/' + f)]
+                    f for f in derdir_files if os.path.isdir(os.path.join(func_dir, f))]
             pipeline_subdir_alternatives = set(pipeline_subdir_alternatives)
             if quiet == 0:
                 print('Pipeline_subdir alternatives: ' +
                       ', '.join(pipeline_subdir_alternatives))
             return list(pipeline_subdir_alternatives)
 
-    def get_selected_files(self, pipeline='pipeline', forfile=None, quiet=0, allowedfileformats='default'):
+    def get_selected_files(self, pipeline='pipeline', forfile=None, quiet=0, allowedfileformats='default', use_cache=True):
         """
         Parameters
         ----------
@@ -551,12 +627,35 @@ class TenetoBIDS:
             A filename or dictionary of file tags. If this is set, only files that match that subject
         accepted_fileformat : list
             list of files formats that are acceptable. Default list is: ['.tsv', '.nii.gz']
+        use_cache : bool
+            If True (default), the files found by a previous call with the same selection are returned
+            as long as none of the searched directories have changed. If False, the directories are always searched.
 
         Returns
         -------
         found_files : list
             The files which are currently selected with the current using the set pipeline, pipeline_subdir, space, parcellation, tasks, runs, subjects etc. There are the files that will generally be used if calling a make_ function.
         """
+        # Results are reused while the selection is the same and none of the listed directories have changed
+        if isinstance(forfile, dict):
+            forfile_key = tuple(sorted(forfile.items()))
+        else:
+            forfile_key = forfile
+        if allowedfileformats != 'default':
+            allowedfileformats_key = tuple(allowedfileformats)
+        else:
+            allowedfileformats_key = allowedfileformats
+        cache_key = (pipeline, forfile_key, allowedfileformats_key, self.pipeline, self.pipeline_subdir,
+                     self.bids_suffix, self.confound_pipeline, tuple(self.bad_files),
+                     tuple((k, tuple(v) if isinstance(v, list) else v) for k, v in sorted(self.bids_tags.items())))
+        if use_cache and cache_key in self._selected_files_cache:
+            listed_dirs, found_files = self._selected_files_cache[cache_key]
+            if all(_dir_mtime(d) == mtime for d, mtime in listed_dirs):
+                found_files = list(found_files)
+                if quiet == 0:
+                    print(found_files)
+                return found_files
+
         # This could be mnade better
         file_dict = dict(self.bids_tags)
         if allowedfileformats == 'default':
@@ -574,8 +673,10 @@ class TenetoBIDS:
             file_dict.pop(n)
 
         # Only keep none empty elemenets
+        # Every file in a directory is checked against all the tags below, so only sub and ses are needed
+        # to find the directories and each directory is listed once (not once per task and run).
         file_components = []
-        for k in ['sub', 'ses', 'task', 'run']:
+        for k in ['sub', 'ses']:
             if k in file_dict:
                 file_components.append([k + '-' + t for t in file_dict[k]])
 
@@ -583,13 +684,13 @@ class TenetoBIDS:
 
         # Specify main directory
         if pipeline == 'pipeline':
-            mdir = self.BIDS_dir + '/derivatives/' + self.pipeline
+            mdir = os.path.join(self.BIDS_dir, 'derivatives', self.pipeline)
         elif pipeline == 'confound' and self.confound_pipeline:
-            mdir = self.BIDS_dir + '/derivatives/' + self.confound_pipeline
+            mdir = os.path.join(self.BIDS_dir, 'derivatives', self.confound_pipeline)
         elif pipeline == 'confound':
-            mdir = self.BIDS_dir + '/derivatives/' + self.pipeline
+            mdir = os.path.join(self.BIDS_dir, 'derivatives', self.pipeline)
         elif pipeline == 'functionalconnectivity':
-            mdir = self.BIDS_dir + '/derivatives/teneto_' + teneto.__version__
+            mdir = os.path.join(self.BIDS_dir, 'derivatives', _TENETO_PIPELINE)
         else:
             raise ValueError('unknown request')
 
@@ -599,26 +700,28 @@ class TenetoBIDS:
 
         found_files = []
 
+        listed_dirs = []
         for f in file_list:
-            wdir = str(mdir)
             sub = [t for t in f if t.startswith('sub')]
             ses = [t for t in f if t.startswith('ses')]
-            wdir += '/' + sub[0] + '/'
-            if ses:
-                wdir += '/' + ses[0] + '/'
-            wdir += '/func/'
+            wdir = os.path.join(mdir, sub[0], *ses[:1], 'func')
 
+            # wdir ends with a separator so file names can be appended
             if pipeline == 'pipeline':
-                wdir += '/' + self.pipeline_subdir + '/'
+                wdir = os.path.join(wdir, self.pipeline_subdir.strip('/'), '')
                 fileending = [self.bids_suffix +
                               f for f in allowedfileformats]
             elif pipeline == 'functionalconnectivity':
-                wdir += '/fc/'
+                wdir = os.path.join(wdir, 'fc', '')
                 fileending = ['conn' + f for f in allowedfileformats]
             elif pipeline == 'confound':
+                wdir = os.path.join(wdir, '')
                 fileending = ['regressors' + f for f in allowedfileformats]
 
-            if os.path.exists(wdir):
+            # A directory's mtime changes when files are added or removed from it
+            wdir_mtime = _dir_mtime(wdir)
+            listed_dirs.append((wdir, wdir_mtime))
+            if wdir_mtime is not None:
                 # make filenames
                 found = []
                 # Check that the tags are in the specified bids tags
@@ -633,8 +736,7 @@ class TenetoBIDS:
                 if pipeline != 'confound':
                     found = [i for i in found if 'desc-confounds' not in i]
                 # Make full paths
-                found = list(
-                    map(str.__add__, [re.sub('/+', '/', wdir)]*len(found), found))
+                found = [wdir + ff for ff in found]
                 # Remove any files in bad files (could add json subcar reading here)
                 found = [i for i in found if not any(
                     [bf in i for bf in self.bad_files])]
@@ -645,6 +747,7 @@ class TenetoBIDS:
                 print(wdir)
 
         found_files = list(set(found_files))
+        self._selected_files_cache[cache_key] = (listed_dirs, list(found_files))
         if quiet == 0:
             print(found_files)
         return found_files
@@ -665,7 +768,7 @@ class TenetoBIDS:
         --------
             calls TenetoBIDS.set_bad_files with the files meeting the exclusion criteria.
         """
-        self.add_history(inspect.stack()[0][3], locals(), 1)
+        self.add_history(sys._getframe().f_code.co_name, locals(), 1)
         if isinstance(confound, str):
             confound = [confound]
         if isinstance(exclusion_criteria, str):
@@ -683,22 +786,25 @@ class TenetoBIDS:
         confound_files = sorted(
             self.get_selected_files(quiet=1, pipeline='confound'))
         files, confound_files = confound_matching(files, confound_files)
+        stat_funcs = {'mean': pd.DataFrame.mean,
+                      'median': pd.DataFrame.median, 'std': pd.DataFrame.std}
         bad_files = []
         bs = 0
         foundconfound = []
         foundreason = []
         for s, cfile in enumerate(confound_files):
-            df = load_tabular_file(cfile, index_col=None)
+            # Confound files can have hundreds of columns, only parse the ones needed
+            df = load_tabular_file(cfile, index_col=None, usecols=list(set(confound)))
+            # One reduction per stat over all the confounds using that stat
+            stat_values = {}
+            for stat in set(confound_stat):
+                if stat in stat_funcs:
+                    stat_values[stat] = stat_funcs[stat](
+                        df[[c for c, cs in zip(confound, confound_stat) if cs == stat]])
             found_bad_subject = False
             for i, _ in enumerate(confound):
-                if confound_stat[i] == 'median':
-                    if relex[i](df[confound[i]].median(), crit[i]):
-                        found_bad_subject = True
-                elif confound_stat[i] == 'mean':
-                    if relex[i](df[confound[i]].mean(), crit[i]):
-                        found_bad_subject = True
-                elif confound_stat[i] == 'std':
-                    if relex[i](df[i][confound[i]].std(), crit[i]):
+                if confound_stat[i] in stat_values:
+                    if relex[i](stat_values[confound_stat[i]][confound[i]], crit[i]):
                         found_bad_subject = True
                 if found_bad_subject:
                     foundconfound.append(confound[i])
@@ -713,11 +819,8 @@ class TenetoBIDS:
             sidecar['file_exclusion'] = {}
             sidecar['confound'] = foundconfound[i]
             sidecar['threshold'] = foundreason[i]
-            for af in ['.tsv', '.nii.gz']:
-                f = f.split(af)[0]
-            f += '.json'
-            with open(f, 'w') as fs:
-                json.dump(sidecar, fs)
+            f = _FILEFORMAT_RE.split(f, 1)[0] + '.json'
+            save_sidecar(f, sidecar)
         print('Removed ' + str(bs) + ' files from inclusion.')
 
     def set_exclusion_timepoint(self, confound, exclusion_criteria, replace_with, tol=1, overwrite=True, desc=None):
@@ -744,7 +847,7 @@ class TenetoBIDS:
         ------
             Loads the TenetoBIDS.selected_files and replaces any instances of confound meeting the exclusion_criteria with replace_with.
         """
-        self.add_history(inspect.stack()[0][3], locals(), 1)
+        self.add_history(sys._getframe().f_code.co_name, locals(), 1)
         if isinstance(confound, str):
             confound = [confound]
         if isinstance(exclusion_criteria, str):
@@ -760,54 +863,33 @@ class TenetoBIDS:
         bad_files = []
         for i, cfile in enumerate(confound_files):
             data = load_tabular_file(files[i]).values
-            df = load_tabular_file(cfile, index_col=None)
-            ind = []
+            df = load_tabular_file(
+                cfile, index_col=None, usecols=list(set(confound)))
+            bad_mask = _exclusion_mask(df[confound].values, relex, crit)
             # Can't interpolate values if nanind is at the beginning or end. So keep these as their original values.
-            for ci, c in enumerate(confound):
-                ind = df[relex[ci](df[c], crit[ci])].index
-                if replace_with == 'cubicspline':
-                    if 0 in ind:
-                        ind = np.delete(ind, np.where(ind == 0))
-                    if df.index.max():
-                        ind = np.delete(ind, np.where(ind == df.index.max()))
-                data[:, ind.astype(int)] = np.nan
-            nanind = np.where(np.isnan(data[0, :]))[0]
-            badpoints_n = len(nanind)
+            if replace_with == 'cubicspline':
+                bad_mask[[0, -1]] = False
+            data[:, bad_mask] = np.nan
+            nan_mask = np.isnan(data[0, :])
+            badpoints_n = int(nan_mask.sum())
             # Bad file if the number of ratio bad points are greater than the tolerance.
+            # Excluded files are not interpolated or saved.
             if badpoints_n / np.array(len(df)) > tol:
                 bad_files.append(files[i])
-            nonnanind = np.where(np.isnan(data[0, :]) == 0)[0]
-            nanind = nanind[nanind > nonnanind.min()]
-            nanind = nanind[nanind < nonnanind.max()]
+                continue
+            nonnanind = np.flatnonzero(~nan_mask)
+            nanind = np.flatnonzero(nan_mask)
+            nanind = nanind[(nanind > nonnanind.min()) & (nanind < nonnanind.max())]
             if replace_with == 'cubicspline':
-                for n in range(data.shape[0]):
-                    interp = interp1d(
-                        nonnanind, data[n, nonnanind], kind='cubic')
-                    data[n, nanind] = interp(nanind)
-            # only save if the subject is not excluded
-            data = pd.DataFrame(data)
-            sname, _ = drop_bids_suffix(files[i])
-            # Move files to teneto derivatives if the pipeline isn't already set to it
-            if self.pipeline != 'teneto_' + teneto.__version__:
-                sname = sname.split('/')[-1]
-                spath = self.BIDS_dir + '/derivatives/' + 'teneto_' + teneto.__version__ + '/'
-                tags = get_bids_tag(sname, ['sub', 'ses'])
-                spath += 'sub-' + tags['sub'] + '/'
-                if 'ses' in tags:
-                    spath += 'ses-' + tags['ses'] + '/'
-                spath += 'func/'
-                if self.pipeline_subdir:
-                    spath += self.pipeline_subdir + '/'
-                make_directories(spath)
-                sname = spath + sname
-            if 'desc' in sname and desc:
-                desctag = get_bids_tag(sname.split('/')[-1], 'desc')
-                sname = ''.join(sname.split('desc-' + desctag['desc']))
-                sname += '_desc-' + desc
-            if os.path.exists(sname + self.bids_suffix + '.tsv') and overwrite == False:
-                raise ValueError(
-                    'overwrite is set to False, but non-unique filename. Set unique desc tag')
-            data.to_csv(sname + '_' + self.bids_suffix + '.tsv', sep='\t')
+                from scipy.interpolate import CubicSpline
+                # One spline over all rows (nodes) as they share the same time-points
+                interp = CubicSpline(nonnanind, data[:, nonnanind], axis=1)
+                data[:, nanind] = interp(nanind)
+            sname = self._derivatives_savename(files[i], desc, overwrite)
+            # Written directly with numpy in the same layout as DataFrame.to_csv (header row of column numbers and an index column)
+            np.savetxt(sname + '_' + self.bids_suffix + '.tsv', np.column_stack([np.arange(data.shape[0]), data]),
+                       fmt=['%d'] + ['%.6g'] * data.shape[1], delimiter='\t', comments='',
+                       header='\t' + '\t'.join(str(c) for c in range(data.shape[1])))
             # Update json sidecar
             sidecar = get_sidecar(files[i])
             sidecar['scrubbed_timepoints'] = {}
@@ -822,11 +904,11 @@ class TenetoBIDS:
             sidecar['scrubbed_timepoints']['badpoint_ratio'] = badpoints_n / \
                 np.array(len(df))
             sidecar['scrubbed_timepoints']['file_exclusion_when_badpoint_ratio'] = tol
-            with open(sname + '_' + self.bids_suffix + '.json', 'w') as fs:
-                json.dump(sidecar, fs)
+            save_sidecar(sname + '_' + self.bids_suffix + '.json', sidecar)
+        self._clear_file_caches()
         self.set_bad_files(
             bad_files, reason='scrubbing (number of points over threshold)')
-        self.set_pipeline('teneto_' + teneto.__version__)
+        self.set_pipeline(_TENETO_PIPELINE)
         if desc:
             self.set_bids_tags({'desc': desc.split('-')[1]})
 
@@ -838,7 +920,8 @@ class TenetoBIDS:
         for f in file_list:
             file_format = f.split('.')[-1]
             if file_format == 'tsv' and os.stat(f).st_size > 0:
-                confounds += list(pd.read_csv(f, delimiter='\t').keys())
+                # Only the header row is needed
+                confounds += list(pd.read_csv(f, delimiter='\t', nrows=0).columns)
 
         confounds = sorted(list(set(confounds)))
 
@@ -846,7 +929,7 @@ class TenetoBIDS:
             print('Confounds in confound files: \n - ' + '\n - '.join(confounds))
         return confounds
 
-    def make_parcellation(self, atlas, template='MNI152NLin2009cAsym', atlas_desc=None, resolution=2, parc_params=None, return_meta=False, update_pipeline=True, removeconfounds=False, tag=None, njobs=None, clean_params=None):
+    def make_parcellation(self, atlas, template='MNI152NLin2009cAsym', atlas_desc=None, resolution=2, parc_params=None, return_meta=False, update_pipeline=True, removeconfounds=False, tag=None, njobs=None, clean_params=None, overwrite=True):
         """
         Reduces the data from voxel to parcellation space. Files get saved in a teneto folder in the derivatives with a roi tag at the end.
 
@@ -879,6 +962,8 @@ class TenetoBIDS:
             Only relevant for when parcellation is schaeffer2018. Use 7 or 17 template networks
         njobs : n
             number of processes to run. Overrides TenetoBIDS.njobs
+        overwrite : bool (default True)
+            If False, files that already have a parcellation output are skipped.
 
         Returns
         -------
@@ -891,7 +976,7 @@ class TenetoBIDS:
         """
         if not njobs:
             njobs = self.njobs
-        self.add_history(inspect.stack()[0][3], locals(), 1)
+        self.add_history(sys._getframe().f_code.co_name, locals(), 1)
 
         # Check confounds have been specified
         if not self.confounds and removeconfounds:
@@ -917,16 +1002,28 @@ class TenetoBIDS:
         if not parc_params:
             parc_params = {}
 
+        # Output paths are found here so only paths and parameters are sent to the workers
+        jobs = []
+        for f in files:
+            fsave, _ = drop_bids_suffix(f)
+            save_name, save_dir, _ = self._save_namepaths_bids_derivatives(
+                fsave, tag, 'parcellation', 'roi', make_dirs=False)
+            if not overwrite and os.path.exists(save_dir + save_name + '.tsv'):
+                continue
+            jobs.append((f, save_name, save_dir, atlas, template,
+                         atlas_desc, resolution, parc_params, return_meta))
+        self._make_derivatives_directories([job[2] for job in jobs])
+
         with ProcessPoolExecutor(max_workers=njobs) as executor:
-            job = {executor.submit(self._run_make_parcellation, f, i, tag, atlas, template,
-                                   atlas_desc, resolution, parc_params, return_meta) for i, f in enumerate(files)}
-            for j in as_completed(job):
-                j.result()
+            if jobs:
+                list(executor.map(_run_make_parcellation, *zip(*jobs),
+                                  chunksize=_chunksize(njobs, len(jobs))))
+        self._clear_file_caches()
 
         if update_pipeline == True:
             if not self.confound_pipeline and len(self.get_selected_files(quiet=1, pipeline='confound')) > 0:
                 self.set_confound_pipeline(self.pipeline)
-            self.set_pipeline('teneto_' + teneto.__version__)
+            self.set_pipeline(_TENETO_PIPELINE)
             self.set_pipeline_subdir('parcellation')
             if tag:
                 self.set_bids_tags({'desc': tag.split('-')[1]})
@@ -935,27 +1032,7 @@ class TenetoBIDS:
                 self.removeconfounds(
                     clean_params=clean_params, transpose=None, njobs=njobs)
 
-    def _run_make_parcellation(self, f, i, tag, atlas, template='MNI152NLin2009cAsym', atlas_desc=None, resolution=2, parc_params=None, return_meta=False):
-        fsave, _ = drop_bids_suffix(f)
-        save_name, save_dir, _ = self._save_namepaths_bids_derivatives(
-            fsave, tag, 'parcellation', 'roi')
-        roi = teneto.utils.make_parcellation(
-            f, atlas, template=template, atlas_desc=atlas_desc, resolution=resolution, parc_params=parc_params, return_meta=return_meta)
-        # Make data node,time
-        roi = roi.transpose()
-        roi = pd.DataFrame(roi.transpose())
-        roi.to_csv(save_dir + save_name + '.tsv', sep='\t')
-        sidecar = get_sidecar(f)
-        sidecar['parcellation'] = parc_params
-        sidecar['parcellation']['description'] = 'The parcellation reduces the FD nifti files to time-series for some parcellation. Parcellation is made using teneto and nilearn.'
-        sidecar['parcellation']['atlas'] = atlas
-        sidecar['parcellation']['atlas_desc'] = atlas_desc
-        sidecar['parcellation']['template'] = template
-        sidecar['parcellation']['resolution'] = resolution
-        with open(save_dir + save_name + '.json', 'w') as fs:
-            json.dump(sidecar, fs)
-
-    def communitydetection(self, community_detection_params, community_type='temporal', tag=None, file_hdr=False, file_idx=False, njobs=None):
+    def communitydetection(self, community_detection_params, community_type='temporal', tag=None, file_hdr=False, file_idx=False, njobs=None, overwrite=True):
         """
         Calls temporal_louvain_with_consensus on connectivity data
 
@@ -972,6 +1049,8 @@ class TenetoBIDS:
             if true, header row present in data and this will be ignored
         njobs : int
             number of processes to run. Overrides TenetoBIDS.njobs
+        overwrite : bool (default True)
+            If False, files that already have communities saved are skipped.
 
         Note
         ----
@@ -984,7 +1063,7 @@ class TenetoBIDS:
         """
         if not njobs:
             njobs = self.njobs
-        self.add_history(inspect.stack()[0][3], locals(), 1)
+        self.add_history(sys._getframe().f_code.co_name, locals(), 1)
 
         if not tag:
             tag = ''
@@ -1002,39 +1081,29 @@ class TenetoBIDS:
             files = self.get_selected_files(
                 quiet=True, pipeline='functionalconnectivity')
 
-        with ProcessPoolExecutor(max_workers=njobs) as executor:
-            job = {executor.submit(self._run_communitydetection, f, community_detection_params, community_type, file_hdr,
-                                   file_idx, tag) for i, f in enumerate(files) if all([t + '_' in f or t + '.' in f for t in tag])}
-            for j in as_completed(job):
-                j.result()
+        jobs = []
+        for f in files:
+            # tag is a single string, so check it as a whole (followed by _ or . as in bids)
+            if tag and not (tag + '_' in f or tag + '.' in f):
+                continue
+            if community_type == 'temporal':
+                save_name, save_dir, _ = self._save_namepaths_bids_derivatives(
+                    f, tag, 'communities', suffix='community', make_dirs=False)
+            else:
+                save_name, _, _ = self._save_namepaths_bids_derivatives(
+                    f, tag, '', suffix='community', make_dirs=False)
+                save_dir = f.split('fc')[0] + '/communities/'
+            if not overwrite and os.path.exists(save_dir + save_name + '.tsv'):
+                continue
+            jobs.append((f, save_name, save_dir,
+                         community_detection_params, community_type))
+        self._make_derivatives_directories([job[2] for job in jobs])
 
-    def _run_communitydetection(self, f, params, community_type, file_hdr=False, file_idx=False, tag=''):
-        if community_type == 'temporal':
-            save_name, save_dir, _ = self._save_namepaths_bids_derivatives(
-                f, tag, 'communities', suffix='community')
-        else:
-            save_name, _, _ = self._save_namepaths_bids_derivatives(
-                f, tag, '', suffix='community')
-            save_dir = f.split('fc')[0] + '/communities/'
-        make_directories(save_dir)
-        data = load_tabular_file(f)
-        # Change this to other algorithms possible in future
-        data = TemporalNetwork(from_df=data)
-        C = teneto.communitydetection.temporal_louvain(data, **params)
-        df = pd.DataFrame(C)
-        df.to_csv(save_dir + save_name + '.tsv', sep='\t')
-        # make sidecar
-        sidecar = get_sidecar(f)
-        # need to remove measure_params[i]['communities'] when saving
-        sidecar['communitydetection'] = {}
-        sidecar['communitydetection']['type'] = community_type
-        if 'resolution_parameter' in params:
-            sidecar['communitydetection']['resolution'] = params['resolution_parameter']
-        if 'interslice_weight' in params:
-            sidecar['communitydetection']['interslice_weight'] = params['interslice_weight']
-        sidecar['communitydetection']['algorithm'] = 'louvain'
-        with open(save_dir + save_name + '.json', 'w') as fs:
-            json.dump(sidecar, fs)
+        with ProcessPoolExecutor(max_workers=njobs) as executor:
+            if jobs:
+                list(executor.map(_run_communitydetection, *zip(*jobs),
+                                  chunksize=_chunksize(njobs, len(jobs))))
+        self._clear_file_caches()
 
     def removeconfounds(self, confounds=None, clean_params=None, transpose=None, njobs=None, update_pipeline=True, overwrite=True, tag=None):
         """
@@ -1065,7 +1134,7 @@ class TenetoBIDS:
         """
         if not njobs:
             njobs = self.njobs
-        self.add_history(inspect.stack()[0][3], locals(), 1)
+        self.add_history(sys._getframe().f_code.co_name, locals(), 1)
 
         if not self.confounds and not confounds:
             raise ValueError(
@@ -1085,75 +1154,22 @@ class TenetoBIDS:
         if not clean_params:
             clean_params = {}
 
-        with ProcessPoolExecutor(max_workers=njobs) as executor:
-            job = {executor.submit(
-                self._run_removeconfounds, f, confound_files[i], clean_params, transpose, overwrite, tag) for i, f in enumerate(files)}
-            for j in as_completed(job):
-                j.result()
+        jobs = [(f, confound_files[i], self._derivatives_savename(f, tag, overwrite),
+                 self.confounds, clean_params, transpose) for i, f in enumerate(files)]
+
+        # nilearn.signal.clean is numpy/scipy work that releases the GIL, so threads are used
+        # and no data has to be pickled to other processes
+        with ThreadPoolExecutor(max_workers=njobs) as executor:
+            if jobs:
+                list(executor.map(_run_removeconfounds, *zip(*jobs)))
+        self._clear_file_caches()
 
-        self.set_pipeline('teneto_' + teneto.__version__)
+        self.set_pipeline(_TENETO_PIPELINE)
         self.set_bids_suffix('roi')
         if tag:
             self.set_bids_tags({'desc': tag.split('-')[1]})
 
-    def _run_removeconfounds(self, file_path, confound_path, clean_params, transpose, overwrite, tag):
-        df = load_tabular_file(confound_path, index_col=None)
-        df = df[self.confounds]
-        roi = load_tabular_file(file_path).values
-        if transpose:
-            roi = roi.transpose()
-        elif len(df) == roi.shape[1] and len(df) != roi.shape[0]:
-            print('Input data appears to be node,time. Transposing.')
-            roi = roi.transpose()
-        warningtxt = ''
-        if df.isnull().any().any():
-            # Not sure what is the best way to deal with this.
-            # The time points could be ignored. But if multiple confounds, this means these values will get ignored
-            warningtxt = 'Some confounds were NaNs. Setting these values to median of confound.'
-            print('WARNING: ' + warningtxt)
-            df = df.fillna(df.median())
-        roi = nilearn.signal.clean(roi, confounds=df.values, **clean_params)
-        if transpose:
-            roi = roi.transpose()
-        roi = pd.DataFrame(roi)
-        sname, _ = drop_bids_suffix(file_path)
-        suffix = 'roi'
-        # Move files to teneto derivatives if the pipeline isn't already set to it
-        if self.pipeline != 'teneto_' + teneto.__version__:
-            sname = sname.split('/')[-1]
-            spath = self.BIDS_dir + '/derivatives/' + 'teneto_' + teneto.__version__ + '/'
-            tags = get_bids_tag(sname, ['sub', 'ses'])
-            spath += 'sub-' + tags['sub'] + '/'
-            if 'ses' in tags:
-                spath += 'ses-' + tags['ses'] + '/'
-            spath += 'func/'
-            if self.pipeline_subdir:
-                spath += self.pipeline_subdir + '/'
-            make_directories(spath)
-            sname = spath + sname
-        if 'desc' in sname and tag:
-            desctag = get_bids_tag(sname.split('/')[-1], 'desc')
-            sname = ''.join(sname.split('desc-' + desctag['desc']))
-            sname += '_desc-' + tag
-        if os.path.exists(sname + self.bids_suffix + '.tsv') and overwrite == False:
-            raise ValueError(
-                'overwrite is set to False, but non-unique filename. Set unique desc tag')
-
-        roi.to_csv(sname + '_' + suffix + '.tsv', sep='\t')
-        sidecar = get_sidecar(file_path)
-        # need to remove measure_params[i]['communities'] when saving
-        if 'confoundremoval' not in sidecar:
-            sidecar['confoundremoval'] = {}
-            sidecar['confoundremoval']['description'] = 'Confounds removed from data using teneto and nilearn.'
-        sidecar['confoundremoval']['params'] = clean_params
-        sidecar['confoundremoval']['confounds'] = self.confounds
-        sidecar['confoundremoval']['confoundsource'] = confound_path
-        if warningtxt:
-            sidecar['confoundremoval']['warning'] = warningtxt
-        with open(sname + '_' + suffix + '.json', 'w') as fs:
-            json.dump(sidecar, fs)
-
-    def networkmeasures(self, measure=None, measure_params=None, tag=None, njobs=None):
+    def networkmeasures(self, measure=None, measure_params=None, tag=None, njobs=None, overwrite=True):
         """
         Calculates a network measure
 
@@ -1172,6 +1188,9 @@ class TenetoBIDS:
         tag : str
             Add additional tag to saved filenames.
 
+        overwrite : bool (default True)
+            If False, measures that have already been saved for a file are not recalculated.
+
         Note
         ----
         In measure_params, if communities can equal 'template', 'static', or 'temporal'.
@@ -1186,7 +1205,7 @@ class TenetoBIDS:
         """
         if not njobs:
             njobs = self.njobs
-        self.add_history(inspect.stack()[0][3], locals(), 1)
+        self.add_history(sys._getframe().f_code.co_name, locals(), 1)
 
         # measure can be string or list
         if isinstance(measure, str):
@@ -1205,21 +1224,26 @@ class TenetoBIDS:
         else:
             tag = 'desc-' + tag
 
+        # The workers need self to load any precalculated communities
         with ProcessPoolExecutor(max_workers=njobs) as executor:
-            job = {executor.submit(
-                self._run_networkmeasures, f, tag, measure, measure_params) for f in files}
-            for j in as_completed(job):
-                j.result()
+            list(executor.map(self._run_networkmeasures, files, itertools.repeat(tag),
+                              itertools.repeat(measure), itertools.repeat(measure_params),
+                              itertools.repeat(overwrite),
+                              chunksize=_chunksize(njobs, len(files))))
+        self._clear_file_caches()
 
-    def _run_networkmeasures(self, f, tag, measure, measure_params):
-        # Load file
-        tvc = load_tabular_file(f)
-        # Make a tenetoobject
-        tvc = teneto.TemporalNetwork(from_df=tvc)
+    def _run_networkmeasures(self, f, tag, measure, measure_params, overwrite=True):
+        # The file is only loaded if a measure needs to be calculated
+        tvc = None
 
         for i, m in enumerate(measure):
             save_name, save_dir, _ = self._save_namepaths_bids_derivatives(
                 f, tag, 'temporalnetwork-' + m, 'tnet')
+            if not overwrite and os.path.exists(save_dir + save_name + '.tsv'):
+                continue
+            if tvc is None:
+                # Load file and make a tenetoobject
+                tvc = teneto.TemporalNetwork(from_df=load_tabular_file(f))
             # This needs to be updated for tsv data.
             if 'communities' in measure_params[i]:
                 if isinstance(measure_params[i]['communities'], str):
@@ -1249,8 +1273,7 @@ class TenetoBIDS:
             sidecar['networkmeasure'] = {}
             sidecar['networkmeasure'][m] = measure_params[i]
             sidecar['networkmeasure'][m]['description'] = 'File contained temporal network estimate: ' + m
-            with open(save_dir + save_name + '.json', 'w') as fs:
-                json.dump(sidecar, fs)
+            save_sidecar(save_dir + save_name + '.json', sidecar)
 
     def set_bad_subjects(self, bad_subjects, reason=None, oops=False):
 
@@ -1303,11 +1326,8 @@ class TenetoBIDS:
                     sidecar['filestatus']['reason'].remove(reason)
                 if len(sidecar['filestatus']['reason']) == 0:
                     sidecar['filestatus']['reject'] = False
-            for af in ['.tsv', '.nii.gz']:
-                f = f.split(af)[0]
-            f += '.json'
-            with open(f, 'w') as fs:
-                json.dump(sidecar, fs)
+            f = _FILEFORMAT_RE.split(f, 1)[0] + '.json'
+            save_sidecar(f, sidecar)
 
         #bad_files = [drop_bids_suffix(f)[0] for f in bad_files]
 
@@ -1333,7 +1353,7 @@ class TenetoBIDS:
 
         """
 
-        self.add_history(inspect.stack()[0][3], locals(), 1)
+        self.add_history(sys._getframe().f_code.co_name, locals(), 1)
 
         if not os.path.exists(self.BIDS_dir + '/derivatives/' + confound_pipeline):
             print('Specified direvative directory not found.')
@@ -1345,7 +1365,7 @@ class TenetoBIDS:
     def set_confounds(self, confounds, quiet=0):
         # This could be mnade better
 
-        self.add_history(inspect.stack()[0][3], locals(), 1)
+        self.add_history(sys._getframe().f_code.co_name, locals(), 1)
 
         file_list = self.get_selected_files(quiet=1, pipeline='confound')
         if isinstance(confounds, str):
@@ -1354,13 +1374,14 @@ class TenetoBIDS:
         for f in file_list:
             file_format = f.split('.')[-1]
             if file_format == 'tsv' and os.stat(f).st_size > 0:
-                sub_confounds = list(pd.read_csv(f, delimiter='\t').keys())
+                # Only the header row is needed
+                sub_confounds = set(pd.read_csv(f, delimiter='\t', nrows=0).columns)
             else:
-                sub_confounds = []
-            for c in confounds:
-                if c not in sub_confounds:
-                    print('Warning: the confound (' +
-                          c + ') not found in file: ' + f)
+                sub_confounds = set()
+            missing = [c for c in confounds if c not in sub_confounds]
+            if missing:
+                print('Warning: the confound(s) (' +
+                      ', '.join(missing) + ') not found in file: ' + f)
 
         self.confounds = confounds
 
@@ -1372,75 +1393,80 @@ class TenetoBIDS:
         netn : int
             only when yeo atlas is used, specifies either 7 or 17.
         """
-        self.add_history(inspect.stack()[0][3], locals(), 1)
+        self.add_history(sys._getframe().f_code.co_name, locals(), 1)
         # Sett if seperate subcortical atlas is specified
         subcortical = ''
         cerebellar = ''
-        if '+' in parcellation:
+        # parcellation is of the form family[_rest][+extra atlases]
+        parcellation, sep, extras = parcellation.partition('+')
+        if sep:
             # Need to add subcortical info to network_communities and network_communities_info_
-            parcin = parcellation
-            parcellation = parcellation.split('+')[0]
-            if '+OH' in parcin:
+            extras = extras.split('+')
+            if 'OH' in extras:
                 subcortical = 'OH'
-            if '+SUIT' in parcin:
+            if 'SUIT' in extras:
                 cerebellar = 'SUIT'
         else:
             subcortical = None
 
-        if parcellation.split('_')[0] != 'schaefer2018':
-            net_path = teneto.__path__[
-                0] + '/data/parcellation/staticcommunities/' + parcellation + '_network.tsv'
+        family, _, rest = parcellation.partition('_')
+        community_dir = os.path.join(
+            teneto.__path__[0], 'data', 'parcellation', 'staticcommunities')
+        if family != 'schaefer2018':
+            net_path = os.path.join(
+                community_dir, parcellation + '_network.tsv')
         else:
-            roin = parcellation.split('_')[1].split('Parcels')[0]
-            net_path = teneto.__path__[
-                0] + '/data/parcellation/staticcommunities/schaefer2018_yeo2011communityinfo_' + roin + 'networks-' + str(netn) + '.tsv'
+            roin = rest.partition('Parcels')[0]
+            net_path = os.path.join(community_dir, 'schaefer2018_yeo2011communityinfo_' +
+                                    roin + 'networks-' + str(netn) + '.tsv')
         nn = 0
         if os.path.exists(net_path):
-            self.communitytemplate_ = pd.read_csv(
-                net_path, index_col=0, sep='\t')
-            self.communitytemplate_info_ = self.communitytemplate_[['community', 'community_id']].drop_duplicates(
-            ).sort_values('community_id').reset_index(drop=True)
-            self.communitytemplate_info_[
-                'number_of_nodes'] = self.communitytemplate_.groupby('community_id').count()['community']
+            # Copied as the parsed template is shared
+            self.communitytemplate_ = _load_community_template(net_path).copy()
+            self.communitytemplate_info_ = _community_info(
+                self.communitytemplate_)
         elif os.path.exists(parcellation):
             self.communitytemplate_ = pd.read_csv(
                 parcellation, index_col=0, sep='\t')
-            self.communitytemplate_info_ = self.communitytemplate_.drop_duplicates(
-            ).sort_values('community_id').reset_index(drop=True)
-            self.communitytemplate_info_[
-                'number_of_nodes'] = self.communitytemplate_.groupby('community_id').count()
+            self.communitytemplate_info_ = _community_info(
+                self.communitytemplate_)
         else:
             nn = 1
             print('No (static) network community file found.')
 
+        # Additional atlases are added as new communities (concatenated once at the end)
+        additional = []
+        if nn == 0:
+            next_id = self.communitytemplate_['community_id'].max() + 1
         if subcortical == 'OH' and nn == 0:
             # Assuming only OH atlas exists for subcortical at the moment.
             node_num = 21
-            sub = pd.DataFrame(data={'community': ['Subcortical (OH)']*node_num, 'community_id': np.repeat(
-                self.communitytemplate_['community_id'].max()+1, node_num)})
-            self.communitytemplate_ = self.communitytemplate_.append(sub)
-            self.communitytemplate_.reset_index(drop=True, inplace=True)
+            additional.append(pd.DataFrame(data={'community': ['Subcortical (OH)']*node_num, 'community_id': np.repeat(
+                next_id, node_num)}))
+            next_id += 1
 
         if cerebellar == 'SUIT' and nn == 0:
             node_num = 34
-            sub = pd.DataFrame(data={'community': ['Cerebellar (SUIT)']*node_num, 'community_id': np.repeat(
-                self.communitytemplate_['community_id'].max()+1, node_num)})
-            self.communitytemplate_ = self.communitytemplate_.append(sub)
-            self.communitytemplate_.reset_index(drop=True, inplace=True)
+            additional.append(pd.DataFrame(data={'community': ['Cerebellar (SUIT)']*node_num, 'community_id': np.repeat(
+                next_id, node_num)}))
+
+        if additional:
+            self.communitytemplate_ = pd.concat(
+                [self.communitytemplate_] + additional, ignore_index=True)
 
     def set_bids_suffix(self, bids_suffix):
         """
         The last analysis step is the final tag that is present in files.
         """
-        self.add_history(inspect.stack()[0][3], locals(), 1)
+        self.add_history(sys._getframe().f_code.co_name, locals(), 1)
         self.bids_suffix = bids_suffix
 
     def set_pipeline(self, pipeline):
         """
         Specify the pipeline. See get_pipeline_alternatives to see what are avaialble. Input should be a string.
         """
-        self.add_history(inspect.stack()[0][3], locals(), 1)
-        if not os.path.exists(self.BIDS_dir + '/derivatives/' + pipeline):
+        self.add_history(sys._getframe().f_code.co_name, locals(), 1)
+        if not os.path.isdir(os.path.join(self.BIDS_dir, 'derivatives', pipeline)):
             print('Specified direvative directory not found.')
             self.get_pipeline_alternatives()
         else:
@@ -1448,7 +1474,7 @@ class TenetoBIDS:
             self.pipeline = pipeline
 
     def set_pipeline_subdir(self, pipeline_subdir):
-        self.add_history(inspect.stack()[0][3], locals(), 1)
+        self.add_history(sys._getframe().f_code.co_name, locals(), 1)
 #        if not os.path.exists(self.BIDS_dir + '/derivatives/' + self.pipeline + '/' + pipeline_subdir):
 #            print('Specified direvative sub-directory not found.')
 #            self.get_pipeline_subdir_alternatives()
@@ -1460,81 +1486,89 @@ class TenetoBIDS:
         """
         Prints information about the the BIDS data and the files currently selected.
         """
+        # The summary is collected and printed at once
+        lines = []
+        lines.append('--- DATASET INFORMATION ---')
 
-        print('--- DATASET INFORMATION ---')
+        # Each BIDSLayout query is only made once (and not at all without raw data)
+        if self.raw_data_exists:
+            subjects = self.BIDS.get_subjects()
+            tasks = self.BIDS.get_tasks()
+            runs = self.BIDS.get_runs()
+            sessions = self.BIDS.get_sessions()
 
-        print('--- Subjects ---')
+        lines.append('--- Subjects ---')
         if self.raw_data_exists:
-            if self.BIDS.get_subjects():
-                print('Number of subjects (in dataset): ' +
-                      str(len(self.BIDS.get_subjects())))
-                print('Subjects (in dataset): ' +
-                      ', '.join(self.BIDS.get_subjects()))
+            if subjects:
+                lines.append('Number of subjects (in dataset): ' +
+                             str(len(subjects)))
+                lines.append('Subjects (in dataset): ' + ', '.join(subjects))
             else:
-                print('NO SUBJECTS FOUND (is the BIDS directory specified correctly?)')
+                lines.append(
+                    'NO SUBJECTS FOUND (is the BIDS directory specified correctly?)')
 
-        print('Number of subjects (selected): ' +
-              str(len(self.bids_tags['sub'])))
-        print('Subjects (selected): ' + ', '.join(self.bids_tags['sub']))
+        lines.append('Number of subjects (selected): ' +
+                     str(len(self.bids_tags['sub'])))
+        lines.append('Subjects (selected): ' + ', '.join(self.bids_tags['sub']))
         if isinstance(self.bad_subjects, list):
-            print('Bad subjects: ' + ', '.join(self.bad_subjects))
+            lines.append('Bad subjects: ' + ', '.join(self.bad_subjects))
         else:
-            print('Bad subjects: 0')
+            lines.append('Bad subjects: 0')
 
-        print('--- Tasks ---')
+        lines.append('--- Tasks ---')
         if self.raw_data_exists:
-            if self.BIDS.get_tasks():
-                print('Number of tasks (in dataset): ' +
-                      str(len(self.BIDS.get_tasks())))
-                print('Tasks (in dataset): ' + ', '.join(self.BIDS.get_tasks()))
+            if tasks:
+                lines.append('Number of tasks (in dataset): ' + str(len(tasks)))
+                lines.append('Tasks (in dataset): ' + ', '.join(tasks))
         if 'task' in self.bids_tags:
-            print('Number of tasks (selected): ' +
-                  str(len(self.bids_tags['task'])))
-            print('Tasks (selected): ' + ', '.join(self.bids_tags['task']))
+            lines.append('Number of tasks (selected): ' +
+                         str(len(self.bids_tags['task'])))
+            lines.append('Tasks (selected): ' + ', '.join(self.bids_tags['task']))
         else:
-            print('No task names found')
+            lines.append('No task names found')
 
-        print('--- Runs ---')
+        lines.append('--- Runs ---')
         if self.raw_data_exists:
-            if self.BIDS.get_runs():
-                print('Number of runs (in dataset): ' +
-                      str(len(self.BIDS.get_runs())))
-                print('Runs (in dataset): ' + ', '.join(self.BIDS.get_runs()))
+            if runs:
+                lines.append('Number of runs (in dataset): ' + str(len(runs)))
+                lines.append('Runs (in dataset): ' + ', '.join(runs))
         if 'run' in self.bids_tags:
-            print('Number of runs (selected): ' +
-                  str(len(self.bids_tags['run'])))
-            print('Rubs (selected): ' + ', '.join(self.bids_tags['run']))
+            lines.append('Number of runs (selected): ' +
+                         str(len(self.bids_tags['run'])))
+            lines.append('Rubs (selected): ' + ', '.join(self.bids_tags['run']))
         else:
-            print('No run names found')
+            lines.append('No run names found')
 
-        print('--- Sessions ---')
+        lines.append('--- Sessions ---')
         if self.raw_data_exists:
-            if self.BIDS.get_sessions():
-                print('Number of runs (in dataset): ' +
-                      str(len(self.BIDS.get_sessions())))
-                print('Sessions (in dataset): ' +
-                      ', '.join(self.BIDS.get_sessions()))
+            if sessions:
+                lines.append('Number of runs (in dataset): ' + str(len(sessions)))
+                lines.append('Sessions (in dataset): ' + ', '.join(sessions))
         if 'ses' in self.bids_tags:
-            print('Number of sessions (selected): ' +
-                  str(len(self.bids_tags['ses'])))
-            print('Sessions (selected): ' + ', '.join(self.bids_tags['ses']))
+            lines.append('Number of sessions (selected): ' +
+                         str(len(self.bids_tags['ses'])))
+            lines.append('Sessions (selected): ' + ', '.join(self.bids_tags['ses']))
         else:
-            print('No session names found')
+            lines.append('No session names found')
 
-        print('--- PREPROCESSED DATA (Pipelines/Derivatives) ---')
+        lines.append('--- PREPROCESSED DATA (Pipelines/Derivatives) ---')
 
         if not self.pipeline:
-            print('Derivative pipeline not set. To set, run TN.set_pipeline()')
+            lines.append(
+                'Derivative pipeline not set. To set, run TN.set_pipeline()')
         else:
-            print('Pipeline: ' + self.pipeline)
+            lines.append('Pipeline: ' + self.pipeline)
         if self.pipeline_subdir:
-            print('Pipeline subdirectories: ' + self.pipeline_subdir)
+            lines.append('Pipeline subdirectories: ' + self.pipeline_subdir)
 
         selected_files = self.get_selected_files(quiet=1)
         if selected_files:
-            print('--- SELECTED DATA ---')
-            print('Numnber of selected files: ' + str(len(selected_files)))
-            print('\n - '.join(selected_files))
+            lines.append('--- SELECTED DATA ---')
+            lines.append('Numnber of selected files: ' +
+                         str(len(selected_files)))
+            lines.append('\n - '.join(selected_files))
+
+        sys.stdout.write('\n'.join(lines) + '\n')
 
     # timelocked average
     # np.stack(a['timelocked-tvc'].values).mean(axis=0)
@@ -1556,7 +1590,7 @@ class TenetoBIDS:
     #     else:
     #         finaltag =  'timelocked.npy'
 
-    #     self.add_history(inspect.stack()[0][3], locals(), 1)
+    #     self.add_history(sys._getframe().f_code.co_name, locals(), 1)
     #     trialinfo_list = []
     #     data_list = []
     #     std_list = []
@@ -1637,37 +1671,41 @@ class TenetoBIDS:
             raise ValueError(
                 'When datatype is temporalnetwork, \'measure\' must also be specified.')
 
-        self.add_history(inspect.stack()[0][3], locals(), 1)
+        self.add_history(sys._getframe().f_code.co_name, locals(), 1)
+        subs = self.bids_tags['sub']
+        # Listing and reading is I/O bound (and pandas' C parser releases the GIL), so each subject directory
+        # and file is handled in a thread pool. Results keep the order of the subjects and files.
+        with ThreadPoolExecutor(max_workers=max(1, min(32, len(subs)))) as executor:
+            filelists = list(executor.map(
+                lambda s: self._get_filelist(datatype, s, tag, measure=measure), subs))
+            paths = []
+            datainfos = []
+            for base_path, file_list, datainfo in filelists:
+                if base_path:
+                    paths += [base_path + f for f in file_list]
+                    datainfos += [datainfo] * len(file_list)
+            loaded = list(executor.map(_load_tabular_file_or_none, paths))
+
         data_list = []
-        trialinfo_list = []
-
-        for s in self.bids_tags['sub']:
-            # Define base folder
-            base_path, file_list, datainfo = self._get_filelist(
-                datatype, s, tag, measure=measure)
-            if base_path:
-                for f in file_list:
-                    # Include only if all analysis step tags are present
-                    # Get all BIDS tags. i.e. in 'sub-AAA', get 'sub' as key and 'AAA' as item.
-                    # Ignore if tsv file is empty
-                    try:
-                        filetags = get_bids_tag(f, 'all')
-                        data_list.append(load_tabular_file(base_path + f))
-                        # Only return trialinfo if datatype is trlinfo
-                        if datainfo == 'trlinfo':
-                            trialinfo_list.append(
-                                pd.DataFrame(filetags, index=[0]))
-                    except pd.errors.EmptyDataError:
-                        pass
+        trialinfo_records = []
+        for f, datainfo, data in zip(paths, datainfos, loaded):
+            # Ignore if tsv file is empty
+            if data is None:
+                continue
+            data_list.append(data)
+            # Only return trialinfo if datatype is trlinfo
+            # Get all BIDS tags. i.e. in 'sub-AAA', get 'sub' as key and 'AAA' as item.
+            if datainfo == 'trlinfo':
+                trialinfo_records.append(get_bids_tag(os.path.basename(f), 'all'))
         # If group data and length of output is one, don't make it a list
         if datatype == 'group' and len(data_list) == 1:
             data_list = data_list[0]
         if measure:
             data_list = {measure: data_list}
         setattr(self, datatype + '_data_', data_list)
-        if trialinfo_list:
-            out_trialinfo = pd.concat(trialinfo_list)
-            out_trialinfo.reset_index(inplace=True, drop=True)
+        if trialinfo_records:
+            # One frame from all the tag dicts (instead of concatenating one row frames)
+            out_trialinfo = pd.DataFrame.from_records(trialinfo_records)
             setattr(self, datatype + '_trialinfo_', out_trialinfo)
 
     # REMAKE BELOW BASED ON THE _events from BIDS
@@ -1705,7 +1743,7 @@ class TenetoBIDS:
     #     -------
     #     Creates a time-locked output placed in BIDS_dir/derivatives/teneto_<version>/..//temporalnetwork/<networkmeasure>/timelocked/
     #     """
-    #     self.add_history(inspect.stack()[0][3], locals(), 1)
+    #     self.add_history(sys._getframe().f_code.co_name, locals(), 1)
     #     #Make sure that event_onsets and event_names are lists
     #     #if  np.any(event_onsets[0]):
     #     #    event_onsets = [e.tolist() for e in event_onsets[0]]
@@ -1766,15 +1804,14 @@ class TenetoBIDS:
     #                     else:
     #                         np.save(save_dir_base + file_name,tl_data)
 
-    def _get_filelist(self, method, sub=None, tags=None, measure=None):
+    def _resolve_base_path(self, method, sub=None, measure=None):
+        """
+        Returns the directory of the method's data (see config/tenetobids/tenetobids.json) for subject sub and the config of method.
+        """
         if measure is None:
             measure = ''
 
-        with open(teneto.__path__[0] + '/config/tenetobids/tenetobids.json') as f:
-            method_info = json.load(f)
-
-        if method == 'temporalnetwork' or method == 'timelocked-temporalnetwork':
-            method_info[method]['pipeline_subdir'] += measure
+        method_info = _load_method_info()
 
         # a = [{},
         # {'derivative': 'fc', 'base': 'pipeline', 'bids_suffix': 'conn'},
@@ -1787,25 +1824,39 @@ class TenetoBIDS:
             raise ValueError('Unknown type of data to load.')
 
         if method_info[method]['base'] == 'pipeline':
+            # method_info is shared between calls so it is not modified
+            pipeline_subdir = method_info[method]['pipeline_subdir']
+            if method == 'temporalnetwork' or method == 'timelocked-temporalnetwork':
+                pipeline_subdir += measure
             base_path = self.BIDS_dir + '/derivatives/' + self.pipeline
-            base_path += '/sub-' + sub + '/func/' + \
-                method_info[method]['pipeline_subdir'] + '/'
+            base_path += '/sub-' + sub + '/func/' + pipeline_subdir + '/'
         elif method_info[method]['base'] == 'BIDS_dir':
             base_path = self.BIDS_dir
-        bids_suffix = method_info[method]['bids_suffix']
+        return base_path, method_info[method]
+
+    def _get_filelist(self, method, sub=None, tags=None, measure=None):
+        base_path, info = self._resolve_base_path(method, sub, measure)
+        # Nothing else is needed if the directory does not exist
+        base_mtime = _dir_mtime(base_path)
+        if base_mtime is None:
+            return None, None, None
+        bids_suffix = info['bids_suffix']
 
         if not tags:
             tags = ['']
         elif isinstance(tags, str):
             tags = [tags]
 
-        if os.path.exists(base_path):
-            file_list = os.listdir(base_path)
-            file_list = [f for f in file_list if os.path.isfile(base_path + f) and all(
-                [t + '_' in f or t + '.' in f for t in tags]) and f.endswith(bids_suffix + '.tsv')]
-            return base_path, file_list, method_info[method]['datatype']
-        else:
-            return None, None, None
+        # All tags must be in the file name, followed by _ or . (one lookahead per tag)
+        tag_pattern = None
+        if any(tags):
+            tag_pattern = re.compile(
+                ''.join('(?=.*' + re.escape(t) + '[_.])' for t in tags if t))
+
+        # The tsv files of a directory are listed once and reused while the directory is unchanged
+        file_list = [f for f in _list_tsv_files(base_path, base_mtime) if f.endswith(bids_suffix + '.tsv') and (
+            tag_pattern is None or tag_pattern.match(f))]
+        return base_path, file_list, info['datatype']
 
     def save_tenetobids_snapshot(self, path, filename='TenetoBIDS_snapshot'):
         """
@@ -1829,15 +1880,284 @@ class TenetoBIDS:
         tnet = teneto.TenetoBIDS(**params)
 
         """
-        tenetobids_dict = self.__dict__
-        tenetobids_init = self.history[0][1]
-        tenetobids_snapshot = {}
-        for n in tenetobids_init:
-            tenetobids_snapshot[n] = tenetobids_dict[n]
+        # The arguments of __init__ are listed in _init_params (history is reset by later steps, so it cannot be used)
+        tenetobids_snapshot = {n: getattr(self, n) for n in self._init_params}
         if not filename.endswith('.json'):
             filename += '.json'
-        with open(path + '/' + filename, 'w') as fs:
-            json.dump(tenetobids_snapshot, fs)
+        with open(os.path.join(path, filename), 'w') as fs:
+            json.dump(tenetobids_snapshot, fs, separators=(',', ':'))
+
+
+def _load_tabular_file_or_none(fname):
+    """
+    Function called by TenetoBIDS.load_data. Returns None if the tsv file is empty.
+    """
+    try:
+        return load_tabular_file(fname)
+    except pd.errors.EmptyDataError:
+        return None
+
+
+@lru_cache(maxsize=256)
+def _list_tsv_files(base_path, mtime):
+    """
+    Sorted names of the tsv files in base_path. mtime (of the directory) is only part of the cache key, so the listing is redone when files are added or removed.
+    """
+    # scandir entries know if they are files without another stat call
+    with os.scandir(base_path) as entries:
+        return tuple(sorted(e.name for e in entries if e.name.endswith('.tsv') and e.is_file()))
+
+
+@lru_cache(maxsize=32)
+def _load_community_template(net_path):
+    """
+    Parses one of the community templates in teneto/data/parcellation/staticcommunities (read once per process).
+    """
+    return pd.read_csv(net_path, index_col=0, sep='\t')
+
+
+def _community_info(template):
+    """
+    Summarises a community template as one row per community_id (community, community_id, number_of_nodes).
+    """
+    info = template.groupby('community_id', sort=True)['community'].agg(['first', 'size'])
+    info = info.rename(columns={'first': 'community', 'size': 'number_of_nodes'}).reset_index()
+    return info[['community', 'community_id', 'number_of_nodes']]
+
+
+@lru_cache(maxsize=1)
+def _load_method_info():
+    """
+    Loads the config of the data types that TenetoBIDS.load_data can load (read once per process).
+    """
+    with open(teneto.__path__[0] + '/config/tenetobids/tenetobids.json') as f:
+        return json.load(f)
+
+
+def _run_confound_report(confound_file, saved_name, saved_dir, dfc, params):
+    """
+    Makes the report (html and histogram figure) of how the edges of dfc correlate with the confounds.
+
+    Called by _run_derive_temporalnetwork with the array it derived, so it does not need to be loaded from the saved tsv.
+    """
+    analysis_step = 'tvc-derive'
+    df = load_tabular_file(confound_file)
+    # Only columns containing NaNs need a median, and a dict fills each column with a scalar
+    nan_columns = df.columns[df.isnull().any().values]
+    if len(nan_columns) > 0:
+        df = df.fillna(df[nan_columns].median().to_dict())
+    # Rows of the (node*node, time) view are contiguous time series, so the upper triangle edges are taken as whole rows
+    edges = np.ravel_multi_index(np.triu_indices(dfc.shape[0], k=1), dfc.shape[:2])
+    dfc_df = pd.DataFrame(dfc.reshape(-1, dfc.shape[-1])[edges].transpose())
+    # If windowed, prune df so that it matches with dfc_df
+    if len(df) != len(dfc_df):
+        df = df.iloc[int(np.round((params['windowsize']-1)/2)): int(np.round((params['windowsize']-1)/2)+len(dfc_df))]
+        df.reset_index(inplace=True, drop=True)
+    # NOW CORRELATE DF WITH DFC BUT ALONG INDEX NOT DF.
+    # z-score both in float32 so all edge-confound correlations are a single matrix product
+    dfc_z = dfc_df.values.astype(np.float32)
+    df_z = df.values.astype(np.float32)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dfc_z = (dfc_z - dfc_z.mean(axis=0)) / dfc_z.std(axis=0)
+        df_z = (df_z - df_z.mean(axis=0)) / df_z.std(axis=0)
+    # Single precision GEMM; dfc_z.T is Fortran ordered so BLAS uses it without a copy
+    from scipy.linalg.blas import sgemm
+    R_df = pd.DataFrame(sgemm(1.0 / len(dfc_z), dfc_z.T, df_z),
+                        index=dfc_df.columns, columns=df.columns)
+    description = R_df.describe().transpose().to_html()
+    # Created by TenetoBIDS.derive_temporalnetwork
+    confound_report_dir = saved_dir + 'report/'
+    report = '<html><body>'
+    report += '<h1> Correlation of ' + analysis_step + ' and confounds.</h1>'
+    # Histogram of every confound column at once. Bins are (edge_k, edge_k+1] like pd.cut
+    bins = np.arange(-1, 1.01, 0.025)
+    nbins = len(bins) - 1
+    bin_idx = np.searchsorted(bins, R_df.values, side='left') - 1
+    in_bins = (bin_idx >= 0) & (bin_idx < nbins)
+    bin_idx += np.arange(R_df.shape[-1]) * nbins
+    confound_hist = np.bincount(bin_idx[in_bins], minlength=R_df.shape[-1] * nbins).reshape(
+        R_df.shape[-1], nbins) / len(R_df)
+
+    import matplotlib
+    # Figures are only saved to file so the worker does not need an interactive backend
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(1, figsize=(8, 1*R_df.shape[-1]))
+    pax = ax.imshow(
+        confound_hist, extent=[-1, 1, R_df.shape[-1], 0], cmap='inferno', vmin=0, vmax=1,
+        interpolation='nearest', rasterized=True)
+    ax.set_aspect('auto')
+    ax.set_yticks(np.arange(0.5, R_df.shape[-1]))
+    ax.set_yticklabels(R_df.columns)
+    ax.set_xlabel('r')
+    plt.colorbar(pax)
+    plt.tight_layout()
+    fig.savefig(confound_report_dir + saved_name +
+                'confounds_2dhist.png', dpi=100)
+    plt.close(fig)
+
+    report += 'The plot below shows histograms of each confound.<br><br>'
+    report += '<img src=' + \
+        confound_report_dir + saved_name + 'confounds_2dhist.png><br><br>'
+    report += '<p>'
+    report += description
+    report += '</body></html>'
+
+    with open(confound_report_dir + saved_name + '_confoundcorr.html', 'w') as file:
+        file.write(report)
+
+
+def _run_derive_temporalnetwork(f, save_name, save_dir, params, fc_files=None, confound_file=None):
+    """
+    Function called by TenetoBIDS.derive_temporalnetwork for concurrent processing.
+
+    Only takes paths (save_name, save_dir and fc_files are found by the parent process) so the TenetoBIDS object is not sent to each worker.
+    If confound_file is given, the confound report of the derived network is also made.
+    """
+    # params is shared by all files in a chunk of executor.map, so do not modify it in place
+    params = dict(params)
+    data = load_tabular_file(f, index_col=True, header=True)
+
+    if 'weight-var' in params.keys():
+        if params['weight-var'] == 'from-subject-fc':
+            if fc_files is not None and len(fc_files) == 1:
+                # Could change to load_data call
+                params['weight-var'] = load_tabular_file(
+                    fc_files[0]).values
+            else:
+                raise ValueError('Cannot correctly find FC files')
+
+    if 'weight-mean' in params.keys():
+        if params['weight-mean'] == 'from-subject-fc':
+            if fc_files is not None and len(fc_files) == 1:
+                # Could change to load_data call
+                params['weight-mean'] = load_tabular_file(
+                    fc_files[0]).values
+            else:
+                raise ValueError('Cannot correctly find FC files')
+
+    if 'dimord' not in params:
+        params['dimord'] = 'time,node'
+
+    dfc = teneto.timeseries.derive_temporalnetwork(data.values, params)
+    dfc_net = TemporalNetwork(
+        from_array=dfc, nettype='wu', forcesparse=True)
+    dfc_net.network.to_csv(save_dir + save_name + '.tsv', sep='\t')
+
+    sidecar = get_sidecar(f)
+    sidecar['tvc'] = params
+    if 'weight-var' in sidecar['tvc']:
+        sidecar['tvc']['weight-var'] = True
+        sidecar['tvc']['fc source'] = fc_files
+    if 'weight-mean' in sidecar['tvc']:
+        sidecar['tvc']['weight-mean'] = True
+        sidecar['tvc']['fc source'] = fc_files
+    sidecar['tvc']['inputfile'] = f
+    sidecar['tvc']['description'] = 'Time varying connectivity information.'
+    save_sidecar(save_dir + save_name + '.json', sidecar)
+    if confound_file is not None:
+        _run_confound_report(confound_file, save_name, save_dir, dfc, params)
+
+
+def _run_make_functional_connectivity(f, save_name, save_dir, file_hdr, file_idx):
+    """
+    Function called by TenetoBIDS.make_functional_connectivity for concurrent processing.
+    """
+    data = load_tabular_file(f)
+    R = data.transpose().corr()
+    R.to_csv(save_dir + save_name + '.tsv', sep='\t')
+    return R.values
+
+
+def _run_make_parcellation(f, save_name, save_dir, atlas, template='MNI152NLin2009cAsym', atlas_desc=None, resolution=2, parc_params=None, return_meta=False):
+    """
+    Function called by TenetoBIDS.make_parcellation for concurrent processing.
+    """
+    roi = teneto.utils.make_parcellation(
+        f, atlas, template=template, atlas_desc=atlas_desc, resolution=resolution, parc_params=parc_params, return_meta=return_meta)
+    # Make data node,time
+    roi = roi.transpose()
+    # Single precision is enough for parcellated time series and shortens the written values
+    roi = pd.DataFrame(roi.transpose()).astype(np.float32, copy=False)
+    roi.to_csv(save_dir + save_name + '.tsv', sep='\t',
+               float_format='%.6g', chunksize=1024)
+    sidecar = get_sidecar(f)
+    sidecar['parcellation'] = dict(parc_params)
+    sidecar['parcellation']['description'] = 'The parcellation reduces the FD nifti files to time-series for some parcellation. Parcellation is made using teneto and nilearn.'
+    sidecar['parcellation']['atlas'] = atlas
+    sidecar['parcellation']['atlas_desc'] = atlas_desc
+    sidecar['parcellation']['template'] = template
+    sidecar['parcellation']['resolution'] = resolution
+    save_sidecar(save_dir + save_name + '.json', sidecar)
+
+
+def _run_communitydetection(f, save_name, save_dir, params, community_type):
+    """
+    Function called by TenetoBIDS.communitydetection for concurrent processing.
+    """
+    data = load_tabular_file(f)
+    # Change this to other algorithms possible in future
+    data = TemporalNetwork(from_df=data)
+    C = teneto.communitydetection.temporal_louvain(data, **params)
+    df = pd.DataFrame(C)
+    df.to_csv(save_dir + save_name + '.tsv', sep='\t')
+    # make sidecar
+    sidecar = get_sidecar(f)
+    # need to remove measure_params[i]['communities'] when saving
+    sidecar['communitydetection'] = {}
+    sidecar['communitydetection']['type'] = community_type
+    if 'resolution_parameter' in params:
+        sidecar['communitydetection']['resolution'] = params['resolution_parameter']
+    if 'interslice_weight' in params:
+        sidecar['communitydetection']['interslice_weight'] = params['interslice_weight']
+    sidecar['communitydetection']['algorithm'] = 'louvain'
+    save_sidecar(save_dir + save_name + '.json', sidecar)
+
+
+def _run_removeconfounds(file_path, confound_path, sname, confounds, clean_params, transpose):
+    """
+    Function called by TenetoBIDS.removeconfounds for concurrent processing.
+
+    sname is the output name (without suffix) found by TenetoBIDS._derivatives_savename.
+    """
+    # Only the confound columns are parsed (usecols does not keep the order of confounds, so they are reselected)
+    df = load_tabular_file(confound_path, index_col=None,
+                           usecols=list(set(confounds)))
+    confound_values = df[confounds].values.astype(np.float64)
+    roi = load_tabular_file(file_path).values
+    if transpose:
+        roi = roi.transpose()
+    elif len(confound_values) == roi.shape[1] and len(confound_values) != roi.shape[0]:
+        print('Input data appears to be node,time. Transposing.')
+        roi = roi.transpose()
+    warningtxt = ''
+    nan_mask = np.isnan(confound_values)
+    if nan_mask.any():
+        # Not sure what is the best way to deal with this.
+        # The time points could be ignored. But if multiple confounds, this means these values will get ignored
+        warningtxt = 'Some confounds were NaNs. Setting these values to median of confound.'
+        print('WARNING: ' + warningtxt)
+        confound_values[nan_mask] = np.take(np.nanmedian(
+            confound_values, axis=0), np.nonzero(nan_mask)[1])
+    import nilearn.signal
+    roi = nilearn.signal.clean(roi, confounds=confound_values, **clean_params)
+    if transpose:
+        roi = roi.transpose()
+    roi = pd.DataFrame(roi).astype(np.float32, copy=False)
+    suffix = 'roi'
+    roi.to_csv(sname + '_' + suffix + '.tsv', sep='\t',
+               float_format='%.6g', chunksize=1024)
+    sidecar = get_sidecar(file_path)
+    # need to remove measure_params[i]['communities'] when saving
+    if 'confoundremoval' not in sidecar:
+        sidecar['confoundremoval'] = {}
+        sidecar['confoundremoval']['description'] = 'Confounds removed from data using teneto and nilearn.'
+    sidecar['confoundremoval']['params'] = clean_params
+    sidecar['confoundremoval']['confounds'] = confounds
+    sidecar['confoundremoval']['confoundsource'] = confound_path
+    if warningtxt:
+        sidecar['confoundremoval']['warning'] = warningtxt
+    save_sidecar(sname + '_' + suffix + '.json', sidecar)
 
 
 if __name__ == '__main__':
@@ -2,7 +2,6 @@ import pandas as pd
 import numpy as np
 import teneto
 import inspect
-import matplotlib.pyplot as plt
 
 
 class TemporalNetwork:
@@ -445,6 +444,7 @@ class TemporalNetwork:
         if t is None:
             t = np.arange(self.netshape[1]).tolist()
         if not ax:
+            import matplotlib.pyplot as plt
             _, ax = plt.subplots(1)
         data_plot = teneto.utils.get_network_when(self, ij=ij, t=t)
         data_plot = teneto.utils.df_to_array(
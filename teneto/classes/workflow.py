@@ -1,6 +1,5 @@
 import teneto
 import numpy as np
-import matplotlib.pyplot as plt
 import inspect
 import pandas as pd
 import copy
@@ -188,6 +187,7 @@ class TenetoWorkflow():
         levelmax = levelunique.max()
         self.runorder.level.unique()
         # if ax is None:
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots(1, figsize=(levelmax*4, levelnum*2))
 
         coord = {}
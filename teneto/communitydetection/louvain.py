@@ -2,7 +2,6 @@ import community
 import pandas as pd
 import numpy as np
 from scipy.spatial.distance import jaccard
-import networkx as nx
 from ..utils import process_input, create_supraadjacency_matrix, tnet_to_nx, clean_community_indexes
 from ..classes import TemporalNetwork
 from concurrent.futures import ProcessPoolExecutor, as_completed
@@ -42,6 +41,7 @@ def temporal_louvain(tnet, resolution=1, intersliceweight=1, n_iter=100, negativ
     ----------
     """
 
+    import networkx as nx
     tnet = process_input(tnet, ['C', 'G', 'TN'], 'TN')
     # Divide resolution by the number of timepoints
     resolution = resolution / tnet.T
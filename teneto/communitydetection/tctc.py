@@ -1,5 +1,4 @@
 import numpy as np
-import networkx as nx
 import pandas as pd
 from teneto.timeseries import derive_temporalnetwork
 
@@ -155,6 +154,7 @@ def tctc(data, tau, epsilon, sigma, kappa=0, largedataset=False, rule='flock', n
     -----------
         tctc : array, df
     """
+    import networkx as nx
     # Get distance matrix
     if largedataset:
         raise NotImplementedError(
@@ -1,7 +1,6 @@
 # Main function to draw a slice_graph
 import numpy as np
-import math
-from .slice_plot import make_bezier
+from .slice_plot import bezier_basis, join_curves
 from ..utils import checkInput, graphlet2contact
 import matplotlib.cm as cm
 
@@ -63,9 +62,7 @@ def circle_plot(netIn, ax, nodelabels=None, linestyle='k-', nodesize=1000, cmap=
     # Convert C representation to G
     if inputType == 'M':
         shape = np.shape(netIn)
-        edg = np.where(np.abs(netIn) > 0)
-        contacts = [tuple([edg[0][i], edg[1][i]])
-                    for i in range(0, len(edg[0]))]
+        contacts = np.argwhere(np.abs(netIn) > 0)
         netIn = {}
         netIn['contacts'] = contacts
         netIn['netshape'] = shape
@@ -74,20 +71,24 @@ def circle_plot(netIn, ax, nodelabels=None, linestyle='k-', nodesize=1000, cmap=
         inputType = 'C'
 
     if inputType == 'C':
-        edgeList = [tuple(np.array(e[0:2]) + e[2] * netIn['netshape'][0])
-                    for e in netIn['contacts']]
+        contacts = np.array(netIn['contacts'], dtype=int).reshape(-1, 3)
+        edgeList = contacts[:, :2] + contacts[:, 2:] * netIn['netshape'][0]
     elif inputType == 'M':
         edgeList = netIn['contacts']
 
     n = netIn['netshape'][0]
     # Get positions of node on unit circle
-    posx = [math.cos((2 * math.pi * i) / n) for i in range(0, n)]
-    posy = [math.sin((2 * math.pi * i) / n) for i in range(0, n)]
+    theta = 2 * np.pi * np.arange(n) / n
+    posx = np.cos(theta)
+    posy = np.sin(theta)
     # Get Bezier lines in a circle
     cmap = cm.get_cmap(cmap)(np.linspace(0, 1, n))
-    for edge in edgeList:
-        bvx, bvy = bezier_circle(
-            (posx[edge[0]], posy[edge[0]]), (posx[edge[1]], posy[edge[1]]), 20)
+    edgeList = np.asarray(edgeList, dtype=int).reshape(-1, 2)
+    pos = np.column_stack([posx, posy])
+    xys = np.stack([pos[edgeList[:, 0]], np.zeros([len(edgeList), 2]), pos[edgeList[:, 1]]], axis=1)
+    curves = np.matmul(bezier_basis(20, 3), xys)
+    if len(curves) > 0:
+        bvx, bvy = join_curves(curves)
         ax.plot(bvx, bvy, linestyle, zorder=0)
     for i in range(n):
         ax.scatter(posx[i], posy[i], s=nodesize, c=cmap[i], zorder=1)
@@ -110,10 +111,5 @@ def circle_plot(netIn, ax, nodelabels=None, linestyle='k-', nodesize=1000, cmap=
 
 # Adapaption of bezier_points but for going in towards the centre of circle
 def bezier_circle(p1, p2, pointN):
-    ts = [t / pointN for t in range(pointN + 1)]
-#    d=p1[0]-(max(p1[1],p2[1])-min(p1[1],p2[1]))/negxLim
-    bezier = make_bezier([p1, (0, 0), p2])
-    points = bezier(ts)
-    bvx = [i[0] for i in points]
-    bvy = [i[1] for i in points]
-    return bvx, bvy
+    points = bezier_basis(pointN, 3).dot([p1, (0, 0), p2])
+    return points[:, 0], points[:, 1]
@@ -1,10 +1,7 @@
-import matplotlib.pyplot as plt
 import numpy as np
 from scipy import ndimage
 from ..utils import contact2graphlet, checkInput
 
-plt.rcParams['axes.facecolor'] = 'white'
-
 
 def graphlet_stack_plot(netin, ax, q=10, cmap='Reds', gridcolor='k', borderwidth=2, bordercolor=None, Fs=1, timeunit='', t0=1, sharpen='yes', vminmax='minmax'):
     r'''
@@ -100,6 +97,9 @@ def graphlet_stack_plot(netin, ax, q=10, cmap='Reds', gridcolor='k', borderwidth
 
     '''
 
+    import matplotlib.pyplot as plt
+    plt.rcParams['axes.facecolor'] = 'white'
+
     # Get input type (C, G, TO)
     inputType = checkInput(netin)
 
@@ -1,5 +1,6 @@
 # Main function to draw a slice_graph
 import numpy as np
+from functools import lru_cache
 from ..utils import *
 
 
@@ -107,8 +108,8 @@ def slice_plot(netin, ax, nodelabels=None, timelabels=None, communities=None, pl
     if inputType == 'G':
         netin = graphlet2contact(netin)
         inputType = 'C'
-    edgelist = [tuple(np.array(e[0:2]) + e[2] * netin['netshape'][0])
-                for e in netin['contacts']]
+    contacts = np.array(netin['contacts'], dtype=int).reshape(-1, 3)
+    edgelist = contacts[:, :2] + contacts[:, 2:] * netin['netshape'][0]
 
     if nodelabels is not None and len(nodelabels) == netin['netshape'][0]:
         pass
@@ -134,8 +135,8 @@ def slice_plot(netin, ax, nodelabels=None, timelabels=None, communities=None, pl
 
     timeNum = len(timelabels)
     nodeNum = len(nodelabels)
-    posy = np.tile(list(range(0, nodeNum)), timeNum)
-    posx = np.repeat(list(range(0, timeNum)), nodeNum)
+    # Node n at time t sits at flat index t * nodeNum + n, i.e. at position (t, n)
+    posx, posy = np.divmod(np.arange(timeNum * nodeNum), nodeNum)
 
     if nodekwargs is None:
         nodekwargs = {}
@@ -155,11 +156,16 @@ def slice_plot(netin, ax, nodelabels=None, timelabels=None, communities=None, pl
 
     # plt.plot(points)
     # Draw Bezier vectors around egde positions
-    for ei, edge in enumerate(edgelist):
-        if plotedgeweights == True and netin['nettype'][0] == 'w':
+    curves = bezier_curves(np.divmod(edgelist[:, 0], nodeNum), np.divmod(
+        edgelist[:, 1], nodeNum), nodeNum, 20)
+    if plotedgeweights == True and netin['nettype'][0] == 'w':
+        # Each edge has its own width so needs its own line
+        for ei, curve in enumerate(curves):
             edgekwargs['linewidth'] = netin['values'][ei] * edgeweightscalar
-        bvx, bvy = bezier_points(
-            (posx[edge[0]], posy[edge[0]]), (posx[edge[1]], posy[edge[1]]), nodeNum, 20)
+            ax.plot(curve[:, 0], curve[:, 1], linestyle, **edgekwargs)
+    elif len(curves) > 0:
+        # Otherwise all edges are drawn as a single line
+        bvx, bvy = join_curves(curves)
         ax.plot(bvx, bvy, linestyle, **edgekwargs)
     ax.set_yticks(range(0, len(nodelabels)))
     ax.set_xticks(range(0, len(timelabels)))
@@ -171,8 +177,8 @@ def slice_plot(netin, ax, nodelabels=None, timelabels=None, communities=None, pl
     ax.spines['right'].set_visible(False)
     ax.get_xaxis().tick_bottom()
     ax.get_yaxis().tick_left()
-    ax.set_xlim([min(posx) - 1, max(posx) + 1])
-    ax.set_ylim([min(posy) - 1, max(posy) + 1])
+    ax.set_xlim([-1, timeNum])
+    ax.set_ylim([-1, nodeNum])
     ax.scatter(posx, posy, s=nodesize, zorder=10, **nodekwargs)
     if timeunit != '':
         timeunit = ' (' + timeunit + ')'
@@ -185,13 +191,40 @@ def slice_plot(netin, ax, nodelabels=None, timelabels=None, communities=None, pl
 # p1 nad p2 are start and end trupes (x,y coords) and pointN is the resolution of the points
 # negxLim tries to restrain how far back along the x axis the bend can go.
 def bezier_points(p1, p2, negxLim, pointN):
-    ts = [t / pointN for t in range(pointN + 1)]
     d = p1[0] - (max(p1[1], p2[1]) - min(p1[1], p2[1])) / negxLim
-    bezier = make_bezier([p1, (d, p1[1]), (d, p2[1]), p2])
-    points = bezier(ts)
-    bvx = [i[0] for i in points]
-    bvy = [i[1] for i in points]
-    return bvx, bvy
+    points = bezier_basis(pointN, 4).dot([p1, (d, p1[1]), (d, p2[1]), p2])
+    return points[:, 0], points[:, 1]
+
+
+def bezier_curves(p1, p2, negxLim, pointN):
+    # Same curves as bezier_points but for all edges at once.
+    # p1 and p2 are (x coords, y coords) pairs of arrays. Returns an (E, pointN+1, 2) array of x,y points.
+    p1x, p1y = [np.asarray(p, dtype=float).ravel() for p in p1]
+    p2x, p2y = [np.asarray(p, dtype=float).ravel() for p in p2]
+    d = p1x - np.abs(p1y - p2y) / negxLim
+    # Control points of each edge, shape (E, 4, 2)
+    xys = np.stack([np.stack([p1x, d, d, p2x], axis=-1),
+                    np.stack([p1y, p1y, p2y, p2y], axis=-1)], axis=-1)
+    return np.matmul(bezier_basis(pointN, 4), xys)
+
+
+def join_curves(curves):
+    # Concatenates an (E, pointN+1, 2) array of curves into single x and y vectors with nan breaks between curves.
+    # This lets one call to ax.plot draw all curves (with a single artist) while still accepting a format string.
+    breaks = np.full([len(curves), 1, 2], np.nan)
+    points = np.concatenate([curves, breaks], axis=1).reshape(-1, 2)
+    return points[:, 0], points[:, 1]
+
+
+@lru_cache(maxsize=None)
+def bezier_basis(pointN, n):
+    # Bernstein coefficients for n control points at pointN+1 evenly spaced ts, shape (pointN+1, n).
+    # Curve points are then basis.dot(control points). Cached as pointN and n are (almost) always the same.
+    ts = np.linspace(0, 1, pointN + 1)
+    combinations = np.array(_PASCAL_ROWS.get(n - 1) or pascal_row(n - 1))
+    basis = combinations * np.vander(ts, n, increasing=True) * np.vander(1 - ts, n)
+    basis.flags.writeable = False
+    return basis
 
 
 # These two functions originated from the plot.ly's documentation for python API.
@@ -199,31 +232,39 @@ def bezier_points(p1, p2, negxLim, pointN):
 def make_bezier(xys):
     # xys should be a sequence of 2-tuples (Bezier control points)
     n = len(xys)
-    combinations = pascal_row(n - 1)
+    # Quadratic and cubic curves (the only ones used by the plots) get closed form versions
+    if n == 3:
+        def bezier(ts):
+            t = np.asarray(ts, dtype=float)
+            mt = 1 - t
+            b0, b1, b2 = mt * mt, 2 * mt * t, t * t
+            return list(zip(*(b0 * ps[0] + b1 * ps[1] + b2 * ps[2] for ps in zip(*xys))))
+        return bezier
+    if n == 4:
+        def bezier(ts):
+            t = np.asarray(ts, dtype=float)
+            mt = 1 - t
+            b0, b1, b2, b3 = mt * mt * mt, 3 * mt * mt * t, 3 * mt * t * t, t * t * t
+            return list(zip(*(b0 * ps[0] + b1 * ps[1] + b2 * ps[2] + b3 * ps[3] for ps in zip(*xys))))
+        return bezier
+    combinations = np.array(_PASCAL_ROWS.get(n - 1) or pascal_row(n - 1))
 
     def bezier(ts):
         # This uses the generalized formula for bezier curves
         # http://en.wikipedia.org/wiki/B%C3%A9zier_curve#Generalization
-        result = []
-        for t in ts:
-            tpowers = (t**i for i in range(n))
-            upowers = reversed([(1 - t)**i for i in range(n)])
-            coefs = [c * a * b for c, a,
-                     b in zip(combinations, tpowers, upowers)]
-            result.append(
-                tuple(sum([coef * p for coef, p in zip(coefs, ps)]) for ps in zip(*xys)))
-        return result
+        t = np.asarray(ts, dtype=float)
+        coefs = combinations * np.vander(t, n, increasing=True) * np.vander(1 - t, n)
+        return list(map(tuple, coefs.dot(xys)))
     return bezier
 
 
+@lru_cache(maxsize=None)
 def pascal_row(n):
-    # This returns the nth row of Pascal's Triangle
+    # This returns the nth row of Pascal's Triangle (memoized, so returned as a tuple)
     result = [1]
     x, numerator = 1, n
     for denominator in range(1, n // 2 + 1):
-        # print(numerator,denominator,x)
-        x *= numerator
-        x /= denominator
+        x = x * numerator // denominator
         result.append(x)
         numerator -= 1
     if n & 1 == 0:
@@ -231,4 +272,8 @@ def pascal_row(n):
         result.extend(reversed(result[:-1]))
     else:
         result.extend(reversed(result))
-    return result
+    return tuple(result)
+
+
+# Rows for the low degree curves drawn by the plots, looked up before falling back to pascal_row.
+_PASCAL_ROWS = {k: pascal_row(k) for k in range(8)}
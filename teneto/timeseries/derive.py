@@ -6,12 +6,17 @@ derive: different methods to derive dynamic functional connectivity
 
 
 import numpy as np
-from statsmodels.stats.weightstats import DescrStatsW
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from ..utils import set_diagonal, getDistanceFunction
 from .postprocess import postpro_pipeline
 from .report import gen_report
 import scipy.stats as sps
 from scipy.signal import hilbert
+from scipy.spatial.distance import cdist
+
+# Largest time*node*node products array for _weighted_pearson_moments
+_MOMENT_MAXSIZE = 2 ** 22
 
 
 def derive_temporalnetwork(data, params):
@@ -56,6 +61,14 @@ def derive_temporalnetwork(data, params):
         Dimension order: 'node,time' (default) or 'time,node'. People like to represent their data differently and this is an easy way to be sure that you are inputing the data in the correct way.
     analysis_id : str or int
         add to identify specfic analysis. Generated report will be placed in './report/' + analysis_id + '/derivation_report.html
+    backend : str
+        'numpy' (default) or 'cupy'. With 'cupy', weighted correlations (distance and user weight matrices)
+        are computed on the GPU. Requires cupy to be installed.
+    njobs : int
+        Number of threads the windows are split over (default 1). Applies to the sliding window and weighted methods.
+    dtype : str
+        Floating point precision of the computation: 'float64' (default) or 'float32'.
+        float32 halves the memory of the intermediate arrays at the cost of precision.
     report : bool
         False by default. If true, A report is saved in ./report/[analysis_id]/derivation_report.html if "yes"
     report_path : str
@@ -155,6 +168,15 @@ def derive_temporalnetwork(data, params):
     if 'postpro' not in params.keys():
         params['postpro'] = 'no'
 
+    if 'dtype' not in params.keys():
+        params['dtype'] = 'float64'
+
+    if 'backend' not in params.keys():
+        params['backend'] = 'numpy'
+
+    if 'njobs' not in params.keys():
+        params['njobs'] = 1
+
     if params['report'] == 'yes' or params['report'] == True:
 
         if 'analysis_id' not in params.keys():
@@ -166,38 +188,23 @@ def derive_temporalnetwork(data, params):
         if 'report_filename' not in params.keys():
             params['report_filename'] = 'derivation_report.html'
 
+    data = np.asarray(data, dtype=params['dtype'])
     if params['dimord'] == 'node,time':
         data = data.transpose()
 
     if isinstance(params['method'], str):
-        if params['method'] == 'jackknife':
-            weights, report = _weightfun_jackknife(data.shape[0], report)
-            relation = 'weight'
-        elif params['method'] == 'sliding window' or params['method'] == 'slidingwindow':
-            weights, report = _weightfun_sliding_window(
-                data.shape[0], params, report)
-            relation = 'weight'
-        elif params['method'] == 'tapered sliding window' or params['method'] == 'taperedslidingwindow':
-            weights, report = _weightfun_tapered_sliding_window(
-                data.shape[0], params, report)
-            relation = 'weight'
-        elif params['method'] == 'distance' or params['method'] == "spatial distance" or params['method'] == "node distance" or params['method'] == "nodedistance" or params['method'] == "spatialdistance":
-            weights, report = _weightfun_spatial_distance(data, params, report)
-            relation = 'weight'
-        elif params['method'] == 'mtd' or params['method'] == 'multiply temporal derivative' or params['method'] == 'multiplytemporalderivative' or params['method'] == 'temporal derivative' or params['method'] == "temporalderivative":
-            R, report = _temporal_derivative(data, params, report)
-            relation = 'coupling'
-        elif params['method'] == 'instantaneousphasesync' or params['method'] == 'ips':
-            R, report = _instantaneous_phasesync(data, params, report)
-            relation = 'coupling'
-        else:
+        if params['method'] not in _METHODS:
             raise ValueError(
                 'Unrecognoized method. See derive_with_weighted_pearson documentation for predefined methods or enter own weight matrix')
+        method_function, relation = _METHODS[params['method']]
+        if relation == 'weight':
+            weights, report = method_function(data, params, report)
+        else:
+            R, report = method_function(data, params, report)
     else:
-        try:
-            weights = np.array(params['method'])
-            relation = 'weight'
-        except:
+        weights = np.array(params['method'])
+        relation = 'weight'
+        if weights.ndim != 2:
             raise ValueError(
                 'Unrecognoized method. See documentation for predefined methods')
         if weights.shape[0] != weights.shape[1]:
@@ -206,30 +213,35 @@ def derive_temporalnetwork(data, params):
             raise ValueError("weight matrix must equal number of time points")
 
     if relation == 'weight':
-        # Loop over each weight vector and calculate pearson correlation.
-        # Note, should see if this can be made quicker in future.
-        R = np.array(
-            [DescrStatsW(data, weights[i, :]).corrcoef for i in range(0, weights.shape[0])])
+        if params['backend'] == 'cupy':
+            import cupy
+            R = cupy.asnumpy(_weighted_pearson(cupy.asarray(data),
+                                               cupy.asarray(weights), xp=cupy))
+        else:
+            R = _weighted_pearson(data, weights, njobs=params['njobs'])
         # Make node,node,time
         R = R.transpose([1, 2, 0])
 
+    # The methods compute windows along the first axis, so lay out node,node,time contiguously
+    # once here for the postprocessing and for the caller
+    R = np.ascontiguousarray(R)
+
     # Correct jackknife direction
-    if params['method'] == 'jackknife':
-        # Correct inversion
-        R = R * -1
+    if isinstance(params['method'], str) and params['method'] == 'jackknife':
+        # Correct inversion (R is a new array here, so this and the steps below are done in place)
+        np.negative(R, out=R)
         jc_z = 0
         if 'weight-var' in params.keys():
-            R = np.transpose(R, [2, 0, 1])
-            R = (R - R.mean(axis=0)) / R.std(axis=0)
+            # Standardize along time
+            R -= R.mean(axis=-1, keepdims=True)
+            R /= R.std(axis=-1, keepdims=True)
             jc_z = 1
-            R = R * params['weight-var']
-            R = R.transpose([1, 2, 0])
+            R *= np.expand_dims(np.asarray(params['weight-var']), -1)
         if 'weight-mean' in params.keys():
-            R = np.transpose(R, [2, 0, 1])
             if jc_z == 0:
-                R = (R - R.mean(axis=0)) / R.std(axis=0)
-            R = R + params['weight-mean']
-            R = np.transpose(R, [1, 2, 0])
+                R -= R.mean(axis=-1, keepdims=True)
+                R /= R.std(axis=-1, keepdims=True)
+            R += np.expand_dims(np.asarray(params['weight-mean']), -1)
         R = set_diagonal(R, 1)
 
     if params['postpro'] != 'no':
@@ -242,58 +254,223 @@ def derive_temporalnetwork(data, params):
     return R
 
 
-def _weightfun_jackknife(T, report):
+def _weighted_pearson(data, weights, blocksize=64, xp=np, njobs=1):
+    """
+    Weighted pearson correlation for each row of weights.
+
+    Parameters
+    ----------
+    data : array
+        Time series with dimensions (time, node).
+    weights : array
+        Weight vectors with dimensions (window, time).
+    blocksize : int
+        Number of weight vectors processed at once. Bounds the size of the (window, time, node) intermediate,
+        where time is restricted to the time points with nonzero weight in the block.
+    xp : module
+        Array module the data and weights belong to (numpy or cupy).
+    njobs : int
+        Number of threads the blocks of windows are split over.
+
+    Returns
+    -------
+    R : array
+        Correlation estimates with dimensions (window, node, node).
+    """
+    data = xp.asarray(data)
+    weights = xp.asarray(weights, dtype=data.dtype)
+    if data.shape[0] * data.shape[1] ** 2 <= _MOMENT_MAXSIZE:
+        return _weighted_pearson_moments(data, weights, xp)
+    R = xp.empty([weights.shape[0], data.shape[1],
+                  data.shape[1]], dtype=data.dtype)
+
+    def _block(i):
+        w = weights[i:i + blocksize]
+        # Only the time points with weight in this block of windows contribute
+        # (for sliding windows this keeps the intermediate small enough to stay in cache)
+        support = xp.flatnonzero(w.any(axis=0))
+        if len(support) > 0:
+            start, stop = int(support[0]), int(support[-1]) + 1
+            w = w[:, start:stop]
+            x = data[start:stop]
+        else:
+            x = data
+        wsum = w.sum(axis=1)
+        mean = xp.dot(w, x) / wsum[:, None]
+        # Center the data within each window and get the weighted covariance
+        demeaned = x[None, :, :] - mean[:, None, :]
+        cov = xp.matmul((w[:, :, None] * demeaned).transpose([0, 2, 1]), demeaned)
+        cov /= wsum[:, None, None]
+        std = xp.sqrt(xp.diagonal(cov, axis1=1, axis2=2))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            R[i:i + blocksize] = cov / std[:, :, None] / std[:, None, :]
+
+    _map_blocks(_block, weights.shape[0], blocksize, njobs)
+    return R
+
+
+def _map_blocks(blockfun, nwindows, blocksize, njobs):
+    """
+    Calls blockfun with the first window index of each block of windows, using njobs threads.
+
+    numpy releases the GIL in the matmuls, so threads are enough to run blocks in parallel.
+    """
+    starts = range(0, nwindows, blocksize)
+    if njobs > 1:
+        with ThreadPoolExecutor(max_workers=njobs) as executor:
+            list(executor.map(blockfun, starts))
+    else:
+        for i in starts:
+            blockfun(i)
+
+
+def _weighted_pearson_moments(data, weights, xp=np):
+    """
+    Weighted pearson correlation from the second moments of the data (small number of nodes).
+
+    All window cross products come from one (window, time) x (time, node*node) matmul,
+    so this is only used when the (time, node*node) products array is small.
     """
-    Creates the weights for the jackknife method. See func: teneto.timeseries.derive_temporalnetwork.
+    # Centering first keeps the moment subtraction below numerically stable
+    data = data - data.mean(axis=0)
+    T, N = data.shape
+    wsum = weights.sum(axis=1)
+    mean = xp.dot(weights, data) / wsum[:, None]
+    products = (data[:, :, None] * data[:, None, :]).reshape([T, N * N])
+    cov = xp.dot(weights, products).reshape([-1, N, N]) / wsum[:, None, None]
+    cov -= mean[:, :, None] * mean[:, None, :]
+    std = xp.sqrt(xp.diagonal(cov, axis1=1, axis2=2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        R = cov / std[:, :, None] / std[:, None, :]
+    return R
+
+
+def _jackknife(data, params, report):
     """
+    Performs the jackknife method. See func: teneto.timeseries.derive_temporalnetwork.
 
-    weights = np.ones([T, T])
-    np.fill_diagonal(weights, 0)
+    Each leave-one-out covariance is the full sample cross product minus the outer
+    product of the left out time point, so no weight matrix is needed.
+    """
+    # Centering makes the full sample sum zero, which simplifies the leave-one-out means
+    data = data - data.mean(axis=0)
+    n = data.shape[0] - 1
+    cov = np.dot(data.transpose(), data) / n
+    # cov[i] = (sum_t x_t x_t' - x_i x_i') / n - mean_i mean_i', where mean_i = -x_i / n
+    cov = cov[None, :, :] - (data.shape[0] / n ** 2) * \
+        (data[:, :, None] * data[:, None, :])
+    std = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        R = cov / std[:, :, None] / std[:, None, :]
+    R = R.transpose([1, 2, 0])
     report['method'] = 'jackknife'
     report['jackknife'] = ''
-    return weights, report
+    return R, report
 
 
-def _weightfun_sliding_window(T, params, report):
+def _windowed_pearson(data, windowsize, taper=None, njobs=1, blocksize=64):
     """
-    Creates the weights for the sliding window method. See func: teneto.timeseries.derive_temporalnetwork.
+    Weighted pearson correlation over sliding windows, with the same taper in every window.
+
+    Only the windowsize time points of each window are used (strided view of the data),
+    so no (window, time) weight matrix is built.
+
+    Parameters
+    ----------
+    data : array
+        Time series with dimensions (time, node).
+    windowsize : int
+        Size of window.
+    taper : array, optional
+        Weights of the windowsize time points within a window. If None, the window is uniform.
+    njobs : int
+        Number of threads the blocks of windows are split over.
+    blocksize : int
+        Number of windows processed at once.
+
+    Returns
+    -------
+    R : array
+        Correlation estimates with dimensions (node, node, window).
     """
-    weightat0 = np.zeros(T)
-    weightat0[0:params['windowsize']] = np.ones(params['windowsize'])
-    weights = np.array([np.roll(weightat0, i)
-                        for i in range(0, T + 1 - params['windowsize'])])
+    # Windowed view of the data (window, node, windowsize) using strides
+    data = np.ascontiguousarray(data.transpose())
+    if taper is not None:
+        taper = np.asarray(taper, dtype=data.dtype)
+    shape = (data.shape[1] - windowsize + 1, data.shape[0], windowsize)
+    strides = (data.strides[-1],) + data.strides
+    windows = np.lib.stride_tricks.as_strided(
+        data, shape=shape, strides=strides)
+    R = np.empty([shape[0], shape[1], shape[1]], dtype=data.dtype)
+
+    def _block(i):
+        x = windows[i:i + blocksize]
+        if taper is None:
+            demeaned = x - x.mean(axis=-1, keepdims=True)
+            cov = np.matmul(demeaned, demeaned.transpose([0, 2, 1]))
+        else:
+            demeaned = x - (np.dot(x, taper) / taper.sum())[:, :, None]
+            cov = np.matmul(demeaned * taper, demeaned.transpose([0, 2, 1]))
+        std = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            R[i:i + blocksize] = cov / std[:, :, None] / std[:, None, :]
+
+    _map_blocks(_block, shape[0], blocksize, njobs)
+    return R.transpose([1, 2, 0])
+
+
+def _sliding_window(data, params, report):
+    """
+    Performs the sliding window method. See func: teneto.timeseries.derive_temporalnetwork.
+    """
+    R = _windowed_pearson(data, params['windowsize'], njobs=params['njobs'])
     report['method'] = 'slidingwindow'
-    report['slidingwindow'] = params
+    report['slidingwindow'] = dict(params)
     report['slidingwindow']['taper'] = 'untapered/uniform'
-    return weights, report
+    return R, report
 
 
-def _weightfun_tapered_sliding_window(T, params, report):
+@lru_cache(maxsize=32)
+def _get_taper(distribution, distribution_params, windowsize):
     """
-    Creates the weights for the tapered method. See func: teneto.timeseries.derive_temporalnetwork.
+    Evaluates the pdf of a scipy distribution over a window centered at 0 (cached).
     """
-    x = np.arange(-(params['windowsize'] - 1) / 2, (params['windowsize']) / 2)
-    taper = getattr(sps, params['distribution']).pdf(x, **params['distribution_params'])
+    x = np.arange(-(windowsize - 1) / 2, windowsize / 2)
+    return getattr(sps, distribution).pdf(x, **dict(distribution_params))
+
 
-    weightat0 = np.zeros(T)
-    weightat0[0:params['windowsize']] = taper
-    weights = np.array([np.roll(weightat0, i)
-                        for i in range(0, T + 1 - params['windowsize'])])
+def _tapered_sliding_window(data, params, report):
+    """
+    Performs the tapered sliding window method. See func: teneto.timeseries.derive_temporalnetwork.
+    """
+    x = np.arange(-(params['windowsize'] - 1) / 2, (params['windowsize']) / 2)
+    try:
+        taper = _get_taper(params['distribution'], tuple(
+            sorted(params['distribution_params'].items())), params['windowsize']).copy()
+    except TypeError:
+        # Unhashable distribution parameters cannot be cached
+        taper = getattr(sps, params['distribution']).pdf(
+            x, **params['distribution_params'])
+
+    R = _windowed_pearson(data, params['windowsize'],
+                          taper=taper, njobs=params['njobs'])
     report['method'] = 'slidingwindow'
-    report['slidingwindow'] = params
+    report['slidingwindow'] = dict(params)
     report['slidingwindow']['taper'] = taper
     report['slidingwindow']['taper_window'] = x
-    return weights, report
+    return R, report
 
 
 def _weightfun_spatial_distance(data, params, report):
     """
     Creates the weights for the spatial distance method. See func: teneto.timeseries.derive_temporalnetwork.
     """
-    distance = getDistanceFunction(params['distance'])
-    weights = np.array([distance(data[n, :], data[t, :]) for n in np.arange(
-        0, data.shape[0]) for t in np.arange(0, data.shape[0])])
-    weights = np.reshape(weights, [data.shape[0], data.shape[0]])
+    try:
+        weights = cdist(data, data, metric=params['distance'])
+    except ValueError:
+        # Metric name not known to cdist, use teneto's lookup as a callable
+        weights = cdist(data, data, metric=getDistanceFunction(
+            params['distance']))
     np.fill_diagonal(weights, np.nan)
     weights = 1 / weights
     weights = (weights - np.nanmin(weights)) / \
@@ -309,21 +486,20 @@ def _temporal_derivative(data, params, report):
     # Data should be timexnode
     report = {}
 
-    # Derivative
-    tdat = data[1:, :] - data[:-1, :]
-    # Normalize
-    tdat = tdat / np.std(tdat, axis=0)
-    # Coupling
-    coupling = np.array([tdat[:, i] * tdat[:, j] for i in np.arange(0,
-                                                                    tdat.shape[1]) for j in np.arange(0, tdat.shape[1])])
-    coupling = np.reshape(
-        coupling, [tdat.shape[1], tdat.shape[1], tdat.shape[0]])
-    # Average over window using strides
-    shape = coupling.shape[:-1] + (coupling.shape[-1] -
-                                   params['windowsize'] + 1, params['windowsize'])
-    strides = coupling.strides + (coupling.strides[-1],)
-    coupling_windowed = np.mean(np.lib.stride_tricks.as_strided(
-        coupling, shape=shape, strides=strides), -1)
+    # Derivative, taken along time in node,time layout so it is contiguous for the windowed view
+    tdat = np.diff(np.ascontiguousarray(data.transpose()), axis=1)
+    # Windowed view of the derivatives (window, node, windowsize) using strides
+    shape = (tdat.shape[-1] - params['windowsize'] + 1,
+             tdat.shape[0], params['windowsize'])
+    strides = (tdat.strides[-1],) + tdat.strides
+    windows = np.lib.stride_tricks.as_strided(
+        tdat, shape=shape, strides=strides)
+    # Average coupling over each window is the (node, node) inner product of the window.
+    # Normalizing by the std of the derivatives and averaging are applied together in place afterwards.
+    coupling_windowed = np.matmul(windows, windows.transpose([0, 2, 1]))
+    std = np.std(tdat, axis=1)
+    coupling_windowed *= 1 / (np.outer(std, std) * params['windowsize'])
+    coupling_windowed = coupling_windowed.transpose([1, 2, 0])
 
     report = {}
     report['method'] = 'temporalderivative'
@@ -339,14 +515,38 @@ def _instantaneous_phasesync(data, params, report):
     """
     analytic_signal = hilbert(data.transpose())
     instantaneous_phase = np.angle(analytic_signal)
-    ips = np.zeros([data.shape[1], data.shape[1], data.shape[0]])
-    for n in range(data.shape[1]):
-        for m in range(data.shape[1]):
-            ips[n, m, :] = np.remainder(
-                np.abs(instantaneous_phase[n, :] - instantaneous_phase[m, :]), 2*np.pi)
+    # Phase difference of every node pair, written straight into the output
+    ips = np.empty([data.shape[1], data.shape[1], data.shape[0]], dtype=data.dtype)
+    np.subtract(instantaneous_phase[:, None, :],
+                instantaneous_phase[None, :, :], out=ips)
+    np.abs(ips, out=ips)
+    np.remainder(ips, 2*np.pi, out=ips)
 
     report = {}
     report['method'] = 'instantaneousphasesync'
     report['instantaneousphasesync'] = {}
 
-    return ips, report
\ No newline at end of file
+    return ips, report
+
+
+# Method names (and their aliases) accepted by derive_temporalnetwork, with the function performing
+# the method and whether it returns weights (for weighted pearson) or the connectivity estimates directly.
+_METHODS = {
+    'jackknife': (_jackknife, 'coupling'),
+    'sliding window': (_sliding_window, 'coupling'),
+    'slidingwindow': (_sliding_window, 'coupling'),
+    'tapered sliding window': (_tapered_sliding_window, 'coupling'),
+    'taperedslidingwindow': (_tapered_sliding_window, 'coupling'),
+    'distance': (_weightfun_spatial_distance, 'weight'),
+    'spatial distance': (_weightfun_spatial_distance, 'weight'),
+    'node distance': (_weightfun_spatial_distance, 'weight'),
+    'nodedistance': (_weightfun_spatial_distance, 'weight'),
+    'spatialdistance': (_weightfun_spatial_distance, 'weight'),
+    'mtd': (_temporal_derivative, 'coupling'),
+    'multiply temporal derivative': (_temporal_derivative, 'coupling'),
+    'multiplytemporalderivative': (_temporal_derivative, 'coupling'),
+    'temporal derivative': (_temporal_derivative, 'coupling'),
+    'temporalderivative': (_temporal_derivative, 'coupling'),
+    'instantaneousphasesync': (_instantaneous_phasesync, 'coupling'),
+    'ips': (_instantaneous_phasesync, 'coupling'),
+}
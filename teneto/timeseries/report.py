@@ -3,7 +3,6 @@ derive.report
 """
 
 import os
-import matplotlib.pyplot as plt
 import numpy as np
 
 
@@ -11,6 +10,7 @@ def gen_report(report, sdir='./', report_name='report.html'):
     """
     Generates report of derivation and postprocess steps in teneto.derive
     """
+    import matplotlib.pyplot as plt
 
     # Create report directory
     if not os.path.exists(sdir):
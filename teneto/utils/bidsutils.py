@@ -2,6 +2,14 @@ import numpy as np
 import pandas as pd
 import os
 import json
+import re
+import copy
+from functools import lru_cache
+
+# Matches the key-value tokens (e.g. 'sub-01') between underscores of a BIDS file name
+_TAG_RE = re.compile(r'(?:^|_)([^_-]*)-([^_-]*)(?=_|$)')
+# Matches the file formats of data files (what is split off to get the sidecar name)
+_FILEFORMAT_RE = re.compile(r'\.tsv|\.nii\.gz')
 
 
 def make_directories(path):
@@ -36,12 +44,8 @@ def drop_bids_suffix(fname):
     ------
     This assumes that there are no periods in the filename
     """
-    if '/' in fname:
-        split = fname.split('/')
-        dirnames = '/'.join(split[:-1]) + '/'
-        fname = split[-1]
-    else:
-        dirnames = ''
+    dirnames, sep, fname = fname.rpartition('/')
+    dirnames += sep
     tags = [tag for tag in fname.split('_') if '-' in tag]
     fname_head = '_'.join(tags)
     fileformat = '.' + '.'.join(fname.split('.')[1:])
@@ -53,16 +57,11 @@ def get_bids_tag(filename, tag):
     filename, _ = drop_bids_suffix(filename)
     if isinstance(tag, str):
         if tag == 'all':
-            for t in filename.split('_'):
-                tag = t.split('-')
-                if len(tag) == 2:
-                    outdict[tag[0]] = tag[1]
-            tag = 'all'
+            outdict = dict(_TAG_RE.findall(filename))
         else:
             tag = [tag]
     if isinstance(tag, list):
-        if '/' in filename:
-            filename = filename.split('/')[-1]
+        filename = os.path.basename(filename)
         for t in tag:
             if t in filename:
                 outdict[t] = filename.split(t + '-')[1].split('_')[0]
@@ -71,7 +70,7 @@ def get_bids_tag(filename, tag):
     return outdict
 
 
-def load_tabular_file(fname, return_meta=False, header=True, index_col=True):
+def load_tabular_file(fname, return_meta=False, header=True, index_col=True, usecols=None):
     """
     Given a file name loads as a pandas data frame
 
@@ -85,6 +84,8 @@ def load_tabular_file(fname, return_meta=False, header=True, index_col=True):
         if there is a header in the tsv file, true will use first row in file.
     index_col : bool (default None)
         if there is an index column in the csv or tsv file, true will use first row in file.
+    usecols : list (default None)
+        if given, only these columns are parsed from the file.
 
     Returns
     -------
@@ -102,7 +103,7 @@ def load_tabular_file(fname, return_meta=False, header=True, index_col=True):
     else:
         header = None
 
-    df = pd.read_csv(fname, header=header, index_col=index_col, sep='\t')
+    df = pd.read_csv(fname, header=header, index_col=index_col, sep='\t', usecols=usecols)
 
     if return_meta:
         json_fname = fname.replace('tsv', 'json')
@@ -121,11 +122,14 @@ def get_sidecar(fname, allowedfileformats='default'):
     for f in allowedfileformats:
         fname = fname.split(f)[0]
     fname += '.json'
-    if os.path.exists(fname):
-        with open(fname) as fs:
-            sidecar = json.load(fs)
-    else:
+    try:
+        stat = os.stat(fname)
+    except OSError:
         sidecar = {}
+    else:
+        # The cached dict is shared, so a copy is returned to be modified
+        sidecar = copy.deepcopy(_load_sidecar(
+            fname, stat.st_mtime_ns, stat.st_size))
     if 'filestatus' not in sidecar:
         sidecar['filestatus'] = {}
         sidecar['filestatus']['reject'] = False
@@ -133,30 +137,72 @@ def get_sidecar(fname, allowedfileformats='default'):
     return sidecar
 
 
+@lru_cache(maxsize=4096)
+def _load_sidecar(fname, mtime, size):
+    """
+    Parses a sidecar. mtime and size are only part of the cache key, so a changed file is read again.
+    """
+    with open(fname) as fs:
+        return json.load(fs)
+
+
+def save_sidecar(fname, sidecar):
+    """
+    Saves sidecar to fname
+
+    The sidecar is encoded to a string first (with the C encoder of json) and written with one call.
+    """
+    sidecar = json.dumps(sidecar)
+    with open(fname, 'w') as fs:
+        fs.write(sidecar)
+    # A rewrite can keep the same mtime on coarse filesystems
+    _load_sidecar.cache_clear()
+
+
 def confound_matching(files, confound_files):
+    """
+    Pairs each file with the confound file that has the same sub, ses, run and task tags.
 
+    The confound files are indexed by their tags (a hash join), so matching is linear in the number of files.
+
+    Parameters
+    ----------
+    files : list
+        data files
+    confound_files : list
+        confound files
+
+    Returns
+    -------
+    files_out : list
+        files
+    confounds_out : list
+        confound file for each of files_out
+    """
     files_out = []
     confounds_out = []
-    files_taglist = []
-    confound_files_taglist = []
-    for f in files:
-        tags = get_bids_tag(f, ['sub', 'ses', 'run', 'task'])
-        files_taglist.append(tags.values())
+    # Index confound files by their tags so each file is matched with one lookup.
+    # Tag names are part of the key so that e.g. ses-1 and run-1 cannot be confused.
+    confound_files_index = {}
     for f in confound_files:
         tags = get_bids_tag(f, ['sub', 'ses', 'run', 'task'])
-        confound_files_taglist.append(tags.values())
+        confound_files_index.setdefault(tuple(tags.items()), []).append(f)
 
-    for i, t in enumerate(files_taglist):
-        j = [j for j, ct in enumerate(
-            confound_files_taglist) if list(t) == list(ct)]
-        if len(j) > 1:
-            raise ValueError(
-                'File/confound matching error (more than one confound file identified)')
-        if len(j) == 0:
+    unmatched = []
+    for f in files:
+        tags = get_bids_tag(f, ['sub', 'ses', 'run', 'task'])
+        matches = confound_files_index.get(tuple(tags.items()), [])
+        if len(matches) > 1:
             raise ValueError(
-                'File/confound matching error (no confound file found)')
-        files_out.append(files[i])
-        confounds_out.append(confound_files[j[0]])
+                'File/confound matching error (more than one confound file identified for ' + f + ')')
+        if len(matches) == 0:
+            unmatched.append(f)
+            continue
+        files_out.append(f)
+        confounds_out.append(matches[0])
+    if unmatched:
+        raise ValueError(
+            'File/confound matching error (no confound file found for: ' + ', '.join(unmatched) + ')')
     return files_out, confounds_out
 
 
@@ -196,3 +242,18 @@ def process_exclusion_criteria(exclusion_criteria):
         else:
             raise ValueError('exclusion crieria must being with >,<,>= or <=')
     return relfun, threshold
+
+
+def _exclusion_mask(values, relfun, threshold):
+    """
+    Returns the rows of values (time, confound) where any column meets its exclusion criteria.
+
+    relfun and threshold are the output of process_exclusion_criteria (one per column).
+    Columns sharing a relation are compared in one broadcast call.
+    """
+    threshold = np.array(threshold, dtype=float)
+    mask = np.zeros(values.shape[0], dtype=bool)
+    for rf in set(relfun):
+        cols = [i for i, r in enumerate(relfun) if r is rf]
+        mask |= rf(values[:, cols], threshold[cols]).any(axis=1)
+    return mask
@@ -1,6 +1,4 @@
-import templateflow.api as tf
 from .bidsutils import load_tabular_file
-from nilearn.input_data import NiftiLabelsMasker
 
 
 def make_parcellation(data_path, atlas, template='MNI152NLin2009cAsym', atlas_desc=None, resolution=2, parc_params=None, return_meta=False):
@@ -35,6 +33,8 @@ def make_parcellation(data_path, atlas, template='MNI152NLin2009cAsym', atlas_de
     ----
     These functions make use of nilearn. Please cite templateflow and nilearn if used in a publicaiton.
     """
+    import templateflow.api as tf
+    from nilearn.input_data import NiftiLabelsMasker
 
     if not parc_params:
         parc_params = {}
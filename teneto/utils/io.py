@@ -1,4 +1,3 @@
-import networkx as nx
 from .utils import get_network_when
 
 
@@ -6,6 +5,7 @@ def tnet_to_nx(df, t=None):
     """
     Creates undirected networkx object
     """
+    import networkx as nx
     if t is not None:
         df = get_network_when(df, t=t)
     if 'weight' in df.columns:
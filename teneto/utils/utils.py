@@ -120,8 +120,7 @@ def graphlet2contact(G, params=None):
         G = np.transpose(G, [1, 2, 0])
     edg = np.where(np.abs(G) > 0)
     sortTime = np.argsort(edg[2])
-    contacts = np.array([tuple([edg[0][i], edg[1][i], edg[2][i]])
-                         for i in sortTime])
+    contacts = np.column_stack(edg)[sortTime]
     # Get each of the values if weighted matrix
     if nt[0] == 'w':
         values = list(G[edg[0][sortTime], edg[1][sortTime], edg[2][sortTime]])
@@ -441,8 +440,9 @@ def set_diagonal(G, val=0):
 
     """
 
-    for t in range(0, G.shape[2]):
-        np.fill_diagonal(G[:, :, t], val)
+    # Diagonal of every time point in one assignment
+    ind = np.arange(min(G.shape[0], G.shape[1]))
+    G[ind, ind, :] = val
     return G
 
 
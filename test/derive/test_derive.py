@@ -34,6 +34,12 @@ def test_taperedslidingwindow():
     # Perhaps make a better test
     if not TR_tsw.shape == (2, 2, 11):
         raise AssertionError()
+    # The taper is reported, not added to the caller's params
+    params = {'method': 'taperedslidingwindow', 'windowsize': 10,
+              'distribution': 'norm', 'distribution_params': {'loc': 0, 'scale': 5}}
+    teneto.timeseries.derive_temporalnetwork(X.transpose(), params)
+    if 'taper' in params:
+        raise AssertionError()
 
 
 def test_jc():
@@ -79,3 +85,13 @@ def test_ip():
         'method': 'ips'})
     if ips2[0, 1, 0] != 0:
         raise AssertionError()
+
+
+def test_weightmatrix():
+    # Uniform weights give the full pearson correlation at every time point
+    X = np.random.multivariate_normal([0, 0, 0], np.eye(3), 20)
+    R = np.corrcoef(X.transpose())
+    TR_w = teneto.timeseries.derive_temporalnetwork(
+        X, {'method': np.ones([20, 20]), 'dimord': 'time,node'})
+    if not np.allclose(TR_w, R[:, :, None]):
+        raise AssertionError()
@@ -1,4 +1,5 @@
 import teneto
+import os
 
 
 def test_define():
@@ -91,3 +92,54 @@ def test_print():
     tnet = teneto.TenetoBIDS(teneto.__path__[0] + '/data/testdata/dummybids/',
                              pipeline='teneto-tests', bids_tags={'task': 'a'}, raw_data_exists=False)
     tnet.print_dataset_summary()
+
+
+def test_layout_reused():
+    tnet1 = teneto.TenetoBIDS(teneto.__path__[0] + '/data/testdata/dummybids/', raw_data_exists=True)
+    tnet2 = teneto.TenetoBIDS(teneto.__path__[0] + '/data/testdata/dummybids/', raw_data_exists=True)
+    if not tnet1.BIDS is tnet2.BIDS:
+        raise AssertionError()
+    # Writing derivatives (what teneto's processing steps do) does not require reindexing
+    fname = teneto.__path__[0] + \
+        '/data/testdata/dummybids/derivatives/teneto-tests/sub-001/func/sub-001_task-a_run-01_layouttest.tsv'
+    open(fname, 'w').close()
+    try:
+        tnet3 = teneto.TenetoBIDS(teneto.__path__[0] + '/data/testdata/dummybids/', raw_data_exists=True)
+    finally:
+        os.remove(fname)
+    if not tnet1.BIDS is tnet3.BIDS:
+        raise AssertionError()
+
+
+def test_layout_reindexed_after_new_file(tmp_path):
+    # A file added in a subdirectory must be seen by the next TenetoBIDS in the same process
+    with open(str(tmp_path / 'dataset_description.json'), 'w') as f:
+        f.write('{"Name": "test", "BIDSVersion": "1.1.1"}')
+    for sub in ['001', '002']:
+        os.makedirs(str(tmp_path / ('sub-' + sub) / 'func'))
+    open(str(tmp_path / 'sub-001' / 'func' / 'sub-001_task-a_bold.nii.gz'), 'w').close()
+    tnet = teneto.TenetoBIDS(str(tmp_path))
+    if not tnet.BIDS.get_tasks() == ['a']:
+        raise AssertionError()
+    open(str(tmp_path / 'sub-002' / 'func' / 'sub-002_task-b_bold.nii.gz'), 'w').close()
+    tnet = teneto.TenetoBIDS(str(tmp_path))
+    if not sorted(tnet.BIDS.get_tasks()) == ['a', 'b']:
+        raise AssertionError()
+
+
+def test_network_communities_from_file(tmp_path):
+    # User supplied template whose community_ids start at 1
+    template = str(tmp_path / 'communities.tsv')
+    with open(template, 'w') as f:
+        f.write('\tcommunity\tcommunity_id\n')
+        for i, (name, cid) in enumerate([('Vis', 1), ('Vis', 1), ('SomMot', 2), ('DMN', 3), ('DMN', 3), ('DMN', 3)]):
+            f.write(str(i) + '\t' + name + '\t' + str(cid) + '\n')
+    tnet = teneto.TenetoBIDS(teneto.__path__[0] + '/data/testdata/dummybids/', raw_data_exists=True)
+    tnet.set_network_communities(template)
+    info = tnet.communitytemplate_info_
+    if not info['community_id'].tolist() == [1, 2, 3]:
+        raise AssertionError()
+    if not info['community'].tolist() == ['Vis', 'SomMot', 'DMN']:
+        raise AssertionError()
+    if not info['number_of_nodes'].tolist() == [2, 1, 3]:
+        raise AssertionError()
@@ -3,6 +3,7 @@ import numpy as np
 from PyQt5 import QtCore
 import json
 import os
+import shutil
 QtCore.QCoreApplication.setAttribute(QtCore.Qt.AA_X11InitThreads, True)
 
 
@@ -75,6 +76,24 @@ def test_make_fc_and_tvc():
         raise AssertionError()
 
 
+def test_selected_files_after_write():
+    # Files written by a processing step are found even if their directory's mtime is unchanged (coarse mtime filesystems)
+    bids_path = teneto.__path__[0] + '/data/testdata/dummybids/'
+    tnet = teneto.TenetoBIDS(bids_path, pipeline='teneto-tests',
+                             pipeline_subdir='parcellation', bids_suffix='roi', bids_tags={'sub': '001', 'task': 'a', 'run': '01'}, raw_data_exists=False)
+    fc_dir = bids_path + 'derivatives/teneto_' + teneto.__version__ + '/sub-001/func/fc/'
+    os.makedirs(fc_dir, exist_ok=True)
+    for f in os.listdir(fc_dir):
+        os.remove(fc_dir + f)
+    if not len(tnet.get_selected_files(quiet=1, pipeline='functionalconnectivity')) == 0:
+        raise AssertionError()
+    dir_stat = os.stat(fc_dir)
+    tnet.make_functional_connectivity()
+    os.utime(fc_dir, ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+    if not len(tnet.get_selected_files(quiet=1, pipeline='functionalconnectivity')) == 1:
+        raise AssertionError()
+
+
 def test_communitydetection():
     tnet = teneto.TenetoBIDS(teneto.__path__[0] + '/data/testdata/dummybids/', pipeline='teneto-tests',
                              pipeline_subdir='tvc', bids_suffix='tvcconn', bids_tags={'sub': '001', 'task': 'b', 'run': '01'}, raw_data_exists=False)
@@ -100,6 +119,50 @@ def test_communitydetection():
     #     raise AssertionError()
 
 
+def _make_tvc_bids(bids_path, descs):
+    # Small BIDS directory with one tvc file per desc tag (copied from the dummy dataset)
+    dummy_path = teneto.__path__[0] + '/data/testdata/dummybids/'
+    tvc_dir = os.path.join(bids_path, 'derivatives', 'pipe', 'sub-001', 'func', 'tvc')
+    os.makedirs(tvc_dir)
+    shutil.copy(dummy_path + 'dataset_description.json', bids_path)
+    for desc in descs:
+        shutil.copy(dummy_path + 'derivatives/teneto-tests/sub-001/func/tvc/sub-001_task-b_run-01_tvcconn.tsv',
+                    os.path.join(tvc_dir, 'sub-001_task-b_run-01_desc-' + desc + '_tvcconn.tsv'))
+    return teneto.TenetoBIDS(bids_path, pipeline='pipe', pipeline_subdir='tvc',
+                             bids_suffix='tvcconn', raw_data_exists=False)
+
+
+def test_communitydetection_tag(tmp_path):
+    # The tag must match a whole bids tag (desc-a is not desc-ab)
+    tnet = _make_tvc_bids(str(tmp_path), ['a', 'ab'])
+    tnet.communitydetection({'resolution': 1, 'intersliceweight': 0}, 'temporal', tag='a')
+    community_dir = os.path.join(str(tmp_path), 'derivatives', 'teneto_' + teneto.__version__,
+                                 'sub-001', 'func', 'communities')
+    saved = [f for f in os.listdir(community_dir) if f.endswith('.tsv')]
+    if not saved == ['sub-001_task-b_run-01_desc-a_desc-a_community.tsv']:
+        raise AssertionError()
+
+
+def test_communitydetection_overwrite(tmp_path):
+    tnet = _make_tvc_bids(str(tmp_path), ['a', 'b'])
+    params = {'resolution': 1, 'intersliceweight': 0}
+    tnet.communitydetection(params, 'temporal')
+    community_dir = os.path.join(str(tmp_path), 'derivatives', 'teneto_' + teneto.__version__,
+                                 'sub-001', 'func', 'communities')
+    existing = os.path.join(community_dir, 'sub-001_task-b_run-01_desc-a_community.tsv')
+    missing = os.path.join(community_dir, 'sub-001_task-b_run-01_desc-b_community.tsv')
+    with open(existing, 'w') as f:
+        f.write('not overwritten')
+    os.remove(missing)
+    # Existing output is left untouched, missing output is written
+    tnet.communitydetection(params, 'temporal', overwrite=False)
+    with open(existing) as f:
+        if not f.read() == 'not overwritten':
+            raise AssertionError()
+    if not os.path.exists(missing):
+        raise AssertionError()
+
+
 def test_networkmeasure():
     # calculate and load a network measure
     bids_path = teneto.__path__[0] + '/data/testdata/dummybids/'
@@ -284,3 +347,12 @@ def test_savesnapshot():
             raise AssertionError()
     if tnet2.__dict__.keys() != tnet.__dict__.keys():
         raise AssertionError()
+
+
+def test_tnet_exclusion_file_stats():
+    tnet = teneto.TenetoBIDS(teneto.__path__[0] + '/data/testdata/dummybids/', pipeline='teneto-tests',
+                             pipeline_subdir='parcellation', bids_suffix='roi', bids_tags={'sub': '001', 'task': 'a', 'run': '01'}, raw_data_exists=False)
+    tnet.set_confound_pipeline('fmriprep')
+    tnet.set_exclusion_file(['confound1', 'confound2'], ['>100', '>0'], confound_stat=['median', 'std'])
+    if not len(tnet.bad_files) == 1:
+        raise AssertionError()
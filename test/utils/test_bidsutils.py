@@ -9,3 +9,16 @@ def test_suffixstripping():
     if not fname_base == 'sub-01_run-02':
         raise AssertionError()
 
+
+
+def test_confound_matching_tag_names():
+    # ses-1 and run-1 share a value, so tag names must be part of the match
+    files = ['sub-01_ses-1_task-a_bold.tsv', 'sub-01_task-a_run-1_bold.tsv']
+    confound_files = ['sub-01_task-a_run-1_desc-confounds_regressors.tsv',
+                      'sub-01_ses-1_task-a_desc-confounds_regressors.tsv']
+    files_out, confounds_out = teneto.utils.bidsutils.confound_matching(
+        files, confound_files)
+    if not files_out == files:
+        raise AssertionError()
+    if not confounds_out == confound_files[::-1]:
+        raise AssertionError()